@@ -7,6 +7,18 @@ import sys
 import collections
 import itertools
 import random
+import array
+import bisect
+import math
+import operator
+import io
+import mmap
+import os
+import struct
+import hashlib
+import concurrent.futures
+import multiprocessing.shared_memory
+import time
 
 """A light wrapper around list that allows for constant-time slices."""
 class list_slice(object):
@@ -41,8 +53,7 @@ class list_slice(object):
         return self.a[self.start+i]
 
     def __iter__(self):
-        for i in range(len(self)):
-            yield self[i]
+        return iter(self.a[self.start:self.stop])
 
     def __repr__(self):
         return "list_slice([{}])".format(", ".join(repr(x) for x in self))
@@ -51,6 +62,106 @@ class list_slice(object):
         """Convert from an into self.a to an index into self"""
         return i - self.start
 
+"""A list of lists of integers packed into two flat arrays
+
+Row i is values[offsets[i]:offsets[i+1]].  Indexing returns a list_slice, so the rows can be read and sliced in constant time just like the lists they replace, but they cannot be modified.
+"""
+class packed_lists(object):
+    def __init__(self, values, offsets):
+        self.values, self.offsets = values, offsets
+
+    @classmethod
+    def from_lists(cls, lists, typecode='i'):
+        values = array.array(typecode)
+        offsets = array.array('q', [0])
+        for row in lists:
+            values.extend(row)
+            offsets.append(len(values))
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        i = len(self)+i if i < 0 else i
+        return list_slice(self.values, self.offsets[i], self.offsets[i+1])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+"""A packed list of tripods
+
+The legs of tripod t are rows 3t, 3t+1, 3t+2 of a packed_lists, so tripods[t][i] is a list_slice containing leg i of tripod t.
+"""
+class packed_tripods(object):
+    def __init__(self, legs):
+        self.legs = legs
+
+    def __len__(self):
+        return len(self.legs) // 3
+
+    def __getitem__(self, t):
+        t = len(self)+t if t < 0 else t
+        return [self.legs[3*t+i] for i in range(3)]
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
+
+
+"""A list of integer triples stored as three flat arrays"""
+class packed_triples(object):
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_tuples(cls, tuples, typecode='i'):
+        return cls(tuple(array.array(typecode, column)
+                         for column in zip(*tuples)))
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, i):
+        a0, a1, a2 = self.columns
+        return (a0[i], a1[i], a2[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+"""A tripod tree stored as a flat (k,3) array of children
+
+Missing children are stored as -1, but indexing returns a list in which missing children are None, as in the unpacked tripod_tree.
+"""
+class packed_tree(object):
+    def __init__(self, children):
+        self.children = children
+
+    @classmethod
+    def from_lists(cls, tree, typecode='i'):
+        children = array.array(typecode, [-1]) * (3*len(tree))
+        for i in range(len(tree)):
+            for j in range(len(tree[i])):
+                if tree[i][j] is not None:
+                    children[3*i+j] = tree[i][j]
+        return cls(children)
+
+    def __len__(self):
+        return len(self.children) // 3
+
+    def __getitem__(self, i):
+        i = len(self)+i if i < 0 else i
+        return [c if c >= 0 else None for c in self.children[3*i:3*i+3]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 """Store a set of integers
 
 This data structure stores integers from the set -1,..,n so that integers can be inserted and the predecessor and successor of any integer can be found in constant time.  Any sequence of insertions takes O(n log n) time.
@@ -81,14 +192,10 @@ class IntegerSet(object):
         a, b = ans
         if b > x:
             if x <= (a+b)//2:
-                ans2 = [a, x]
-                for i in range(a+1, x+1):
-                    self.answers[i] = ans2
+                self.answers[a+1:x+1] = [[a, x]]*(x-a)
                 ans[0] = x
             else:
-                ans2 = [x, b]
-                for i in range(x+1, b+1):
-                    self.answers[i] = ans2
+                self.answers[x+1:b+1] = [[x, b]]*(b-x)
                 ans[1] = x
 
     def __iter__(self):
@@ -102,93 +209,434 @@ class IntegerSet(object):
         return "IntegerSet({},[{}])".format(self.n,
                                              ",".join(str(x) for x in self))
 
+"""Store a set of integers in a tree of bitsets
+
+This has the same interface as IntegerSet, but stores the integers in the set 0,...,n-1 as bits of 64-bit words.  A second level of words records which words of the first level are non-empty, and so on, so a query or insertion takes O(log n / log 64) time and the whole structure uses O(n) bits.  As in IntegerSet, -1 and n behave as though they are always in the set.
+"""
+class BitsetIntegerSet(object):
+    def __init__(self, n, population=[]):
+        self._n = n
+        self.levels = list()
+        size = n
+        while True:
+            size = (size + 63) >> 6
+            self.levels.append([0]*max(size, 1))
+            if size <= 1:
+                break
+        for x in population:
+            self.add(x)
+
+    def get_n(self):
+        return self._n
+
+    n = property(get_n, None)
+
+    def interval(self, x):
+        return (self.predecessor(x), self.successor(x))
+
+    """Return the smallest element of the set that is at least x"""
+    def successor(self, x):
+        levels = self.levels
+        l = 0
+        while True:
+            if l == len(levels) or x >> 6 >= len(levels[l]):
+                return self._n
+            w = levels[l][x >> 6] >> (x & 63)
+            if w:
+                x += (w & -w).bit_length() - 1
+                break
+            x = (x >> 6) + 1
+            l += 1
+        while l > 0:
+            l -= 1
+            w = levels[l][x]
+            x = (x << 6) + (w & -w).bit_length() - 1
+        return min(x, self._n)
+
+    """Return the largest element of the set that is less than x"""
+    def predecessor(self, x):
+        levels = self.levels
+        x -= 1
+        l = 0
+        while True:
+            if l == len(levels) or x < 0:
+                return -1
+            w = levels[l][x >> 6] & ((2 << (x & 63)) - 1)
+            if w:
+                x = (x & ~63) + w.bit_length() - 1
+                break
+            x = (x >> 6) - 1
+            l += 1
+        while l > 0:
+            l -= 1
+            x = (x << 6) + levels[l][x].bit_length() - 1
+        return x
+
+    def add(self, x):
+        if x < 0 or x >= self._n:
+            return
+        for words in self.levels:
+            j = x >> 6
+            w = words[j]
+            words[j] = w | (1 << (x & 63))
+            if w:
+                break
+            x = j
+
+    def __iter__(self):
+        x = self.successor(0)
+        while x < self.n:
+            yield x
+            x = self.successor(x+1)
+
+    def __repr__(self):
+        return "BitsetIntegerSet({},[{}])".format(self.n,
+                                                  ",".join(str(x) for x in self))
+
+"""The integer set implementations that MarkedAncestorStruct can use"""
+integer_sets = {'interval': IntegerSet, 'bitset': BitsetIntegerSet}
+
 """Nearest Marked Ancestor data Structure
 
 Preprocesses a rooted tree so that we can mark any node whose parent is marked and so that we can find the nearest marked ancestor of any node in constant time. Any sequence of mark operations takes O(n log n) time.
 
 The input is a forest with vertex set 0,...,n-1 and list of roots that should be initially marked.  The input format for the forest (tree) is a list of length n, where tree[i][0] is the parent of i (or -1 if i is a root) and tree[i][1:] are the children of i.
 
-This performs an Euler tour of the forest so that each edge e gets mapped to an interval [a(e),b(e)].  If some edge e' is a descendant of e than [a(e'),b(e')] is strictly contained in [a(e),b(e)].
+This performs an Euler tour of the forest so that each edge e gets mapped to an interval [a(e),b(e)].  If some edge e' is a descendant of e than [a(e'),b(e')] is strictly contained in [a(e),b(e)].  The endpoints of the intervals of marked nodes are stored in intset, an IntegerSet by default.  Any class with the same constructor, add() and successor() can be used instead; see integer_sets.
 """
 class MarkedAncestorStruct(object):
-    def __init__(self, tree, roots):
+    def __init__(self, tree, roots, intset=IntegerSet):
+        if not isinstance(tree, bfs_tree):
+            tree = bfs_tree.from_lists(tree)
         n = len(tree)
         self.tree = tree
-        self.intervals = [None]*n
+        self.parent = tree.parent
+        self.enter = array.array('i', [0]) * n
+        self.exit = array.array('i', [0]) * n
 
-        self.tour = list()
+        self.tour = array.array('i')
         for r in roots:
             self.euler_tour(r)
 
         m = len(self.tour)
-        self.intset = IntegerSet(m)
-        self.marked = [False]*n
+        self.intset = intset(m)
+        self.marked = bytearray(n)
         for r in roots:
             self.mark(r)
 
-    def is_marked(self, v):
-        return self.marked[v]
-
     def mark(self, v):
         self.marked[v] = True
         self._mark_node(v)
-        for w in self.tree[v][1:]:
-            self._mark_node(w)
+        t = self.tree
+        for i in range(t.first_child[v], t.first_child[v]+t.num_children[v]):
+            self._mark_node(t.order[i])
 
     def _mark_node(self, w):
-        a, b = self.intervals[w]
-        self.intset.add(a)
-        self.intset.add(b)
+        self.intset.add(self.enter[w])
+        self.intset.add(self.exit[w])
 
     def nearest_marked_ancestor(self, v):
-        x = self.intervals[v][1]
-        a,b = self.intset.interval(x)
+        b = self.intset.successor(self.exit[v])
         a = self.tour[b]
         if not self.marked[a]:
-            a = self.tree[a][0]
+            a = self.parent[a]
         return a
 
     def is_marked(self, v):
         return self.marked[v]
 
     def euler_tour(self, r):
-        tour = list()
-        stack = list()
-        stack.append((r, 1))
-        self.intervals[r] = len(self.tour)
-        self.tour.append(r)
-        while (stack):
-            u, i = stack.pop()
-            if i < len(self.tree[u]):
-                stack.append((u, i+1))
-                v = self.tree[u][i]
-                stack.append((v, 1))
-                self.intervals[v] = len(self.tour)
-                self.tour.append(v)
+        t = self.tree
+        order, first_child, num_children = t.order, t.first_child, t.num_children
+        tour, enter, exit = self.tour, self.enter, self.exit
+        # stack[i] is a vertex and nexts[i] is the position in order of the
+        # next child of stack[i] to visit
+        stack = [r]
+        nexts = [first_child[r]]
+        enter[r] = len(tour)
+        tour.append(r)
+        while stack:
+            u = stack[-1]
+            i = nexts[-1]
+            if i < first_child[u] + num_children[u]:
+                nexts[-1] = i+1
+                v = order[i]
+                enter[v] = len(tour)
+                tour.append(v)
+                stack.append(v)
+                nexts.append(first_child[v])
             else:
-                self.intervals[u] = (self.intervals[u], len(self.tour))
-                self.tour.append(u)
-        return tour
+                exit[u] = len(tour)
+                tour.append(u)
+                stack.pop()
+                nexts.pop()
+
+"""A compact, array-based representation of a planar triangulation
+
+This stores the same information as the list-of-dictionaries succ representation used by tripod_partition, but in three flat integer arrays that use a few bytes per half-edge.  The neighbours of vertex u are heads[offsets[u]:offsets[u+1]], sorted in increasing order, so that h = offsets[u] + i is the half-edge (directed edge) from u to heads[h].  The rotation array gives the counterclockwise order around u: rotation[h] is the half-edge from u to the neighbour that appears immediately after heads[h], so (u, heads[h], heads[rotation[h]]) is the face to the left of h.
+
+A csr_triangulation can be used anywhere that a succ list is expected: len(g) is the number of vertices and g[u][v] is the third vertex of the face to the left of uv, just like succ[u][v].  Looking up g[u][v] takes O(log deg(u)) time.
+"""
+class csr_triangulation(object):
+    def __init__(self, offsets, heads, rotation):
+        assert(len(heads) == len(rotation) == offsets[-1])
+        self.offsets, self.heads, self.rotation = offsets, heads, rotation
+
+    """Build a csr_triangulation from a list of faces
+
+    Each face is a triple (u,v,w) of vertices listed in counterclockwise order.  Alternatively, faces can be a flat sequence of length 3f in which positions 3i, 3i+1, 3i+2 are the vertices of face i.
+    """
+    @classmethod
+    def from_faces(cls, faces, n=None):
+        if len(faces) > 0 and not isinstance(faces[0], int):
+            faces = array.array('i', itertools.chain.from_iterable(faces))
+        else:
+            faces = array.array('i', faces)
+        if len(faces) % 3 != 0:
+            raise ValueError("number of face vertices is not a multiple of 3")
+        if n is None:
+            n = max(faces) + 1 if faces else 0
+        # the half-edges of face (a,b,c) are ab, bc, ca and the next
+        # half-edges around a, b, c are ac, ba, cb, respectively
+        nbrs = array.array('i', bytes(4*len(faces)))
+        nexts = array.array('i', bytes(4*len(faces)))
+        nbrs[0::3], nbrs[1::3], nbrs[2::3] = faces[1::3], faces[2::3], faces[0::3]
+        nexts[0::3], nexts[1::3], nexts[2::3] = faces[2::3], faces[0::3], faces[1::3]
+        return cls._from_half_edges(n, faces, nbrs, nexts)
+
+    """Build a csr_triangulation from a list of dictionaries succ"""
+    @classmethod
+    def from_succ(cls, succ):
+        tails = array.array('i', itertools.chain.from_iterable(
+            itertools.repeat(u, len(succ[u])) for u in range(len(succ))))
+        nbrs = array.array('i', itertools.chain.from_iterable(
+            d.keys() for d in succ))
+        nexts = array.array('i', itertools.chain.from_iterable(
+            d.values() for d in succ))
+        return cls._from_half_edges(len(succ), tails, nbrs, nexts)
+
+    """Build a csr_triangulation from the half-edges tails[i]->nbrs[i]
+
+    nexts[i] is the neighbour of tails[i] that follows nbrs[i] in
+    counterclockwise order.  The half-edges are bucketed by tail with a
+    counting sort (count the degrees, take prefix sums, then place each
+    half-edge), so only arrays of length m are allocated.  Each row is
+    then sorted by neighbour, which gives heads, and the rotation maps
+    each half-edge to the position of its next neighbour in the row.
+    """
+    @classmethod
+    def _from_half_edges(cls, n, tails, nbrs, nexts):
+        m = len(tails)
+        offsets = array.array('q', bytes(8*(n+1)))
+        for u in tails:
+            offsets[u+1] += 1
+        for u in range(n):
+            offsets[u+1] += offsets[u]
+        free = offsets[:-1]
+        heads = array.array('i', bytes(4*m))
+        rotation = array.array('i', bytes(4*m))
+        for (u, v, w) in zip(tails, nbrs, nexts):
+            h = free[u]
+            free[u] = h+1
+            heads[h] = v
+            rotation[h] = w
+        del free
+        for u in range(n):
+            s, e = offsets[u], offsets[u+1]
+            if s == e:
+                continue
+            row, ws = zip(*sorted(zip(heads[s:e], rotation[s:e])))
+            position = dict(zip(row, range(s, e)))
+            if len(position) < e - s:
+                v = next(v for (v, w) in zip(row, row[1:]) if v == w)
+                raise EmbeddingError("half-edge ({},{}) appears twice"
+                                     .format(u, v), vertices=[u, v])
+            try:
+                rotation[s:e] = array.array('i', map(position.__getitem__, ws))
+            except KeyError as error:
+                w = error.args[0]
+                raise EmbeddingError("half-edge ({},{}) is not part of any "
+                                     "face".format(u, w), vertices=[u, w])
+            heads[s:e] = array.array('i', row)
+        return cls(offsets, heads, rotation)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, u):
+        return _csr_row(self, u)
+
+    def __iter__(self):
+        for u in range(len(self)):
+            yield _csr_row(self, u)
+
+    def num_half_edges(self):
+        return len(self.heads)
+
+    def degree(self, u):
+        return self.offsets[u+1] - self.offsets[u]
+
+    """Return the half-edge from u to v (raises KeyError if uv is not an edge)"""
+    def edge(self, u, v):
+        s, e = self.offsets[u], self.offsets[u+1]
+        h = bisect.bisect_left(self.heads, v, s, e)
+        if h == e or self.heads[h] != v:
+            raise KeyError(v)
+        return h
+
+    """Return the third vertex of the face to the left of uv"""
+    def third(self, u, v):
+        return self.heads[self.rotation[self.edge(u, v)]]
+
+    """Return the neighbours of u in counterclockwise order"""
+    def rotation_order(self, u):
+        s = self.offsets[u]
+        h = s
+        while True: # emulating do ... while h != s
+            yield self.heads[h]
+            h = self.rotation[h]
+            if h == s: break
+
+    """Convert back to the list of dictionaries representation"""
+    def to_succ(self):
+        succ = list()
+        for u in range(len(self)):
+            s, e = self.offsets[u], self.offsets[u+1]
+            succ.append({self.heads[h]: self.heads[self.rotation[h]]
+                         for h in range(s, e)})
+        return succ
+
+
+"""A read-only view of the neighbours of one vertex in a csr_triangulation
+
+This behaves like the dictionary succ[u]: iterating gives the neighbours of u and row[v] gives the vertex that follows v in the counterclockwise order around u.
+"""
+class _csr_row(object):
+    __slots__ = ('g', 'u')
+
+    def __init__(self, g, u):
+        self.g, self.u = g, u
+
+    def __len__(self):
+        return self.g.offsets[self.u+1] - self.g.offsets[self.u]
+
+    def __iter__(self):
+        g = self.g
+        for h in range(g.offsets[self.u], g.offsets[self.u+1]):
+            yield g.heads[h]
+
+    def __contains__(self, v):
+        try:
+            self.g.edge(self.u, v)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, v):
+        g = self.g
+        return g.heads[g.rotation[g.edge(self.u, v)]]
+
+    def get(self, v, default=None):
+        try:
+            return self[v]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return iter(self)
+
 
 """An implementation of breadth-first-search
 
-This implementation takes a list of roots that form the depth-0 nodes of the breadth-first-search forest.  The output format is compatible with the MarkedAncestorStruct structure.
+This implementation takes a list of roots that form the depth-0 nodes of the breadth-first-search forest.  The output format is compatible with the MarkedAncestorStruct structure.  It is computed by bfs_arrays and converted to lists, which is only worth doing for code that needs the lists.
 """
 def bfs_forest(succ, roots):
-    t = [list() for _ in succ]
-    for v in roots:
-        t[v].append(-1)
-    q = collections.deque(roots)
-    seen = set(roots)  # TODO: array would be faster
-    while len(q) > 0:
-        v = q.pop()
+    t = bfs_arrays(succ, roots)
+    return [t[v] for v in range(len(t))]
+
+
+"""A breadth-first-search forest stored in flat arrays
+
+parent[v] is the parent of v (-1 for a root) and depth[v] is the depth of v, i.e., its BFS layer.  order lists the vertices in BFS order, so the children of each vertex are consecutive in it: the children of v are order[first_child[v]:first_child[v]+num_children[v]].  Indexing gives the same lists as bfs_forest, so t[v][0] is the parent of v and t[v][1:] are its children, but this allocates a list, so the arrays are faster.
+"""
+class bfs_tree(object):
+    def __init__(self, parent, depth, order, first_child, num_children):
+        self.parent, self.depth, self.order = parent, depth, order
+        self.first_child, self.num_children = first_child, num_children
+
+    """Convert a forest in the list format used by bfs_forest"""
+    @classmethod
+    def from_lists(cls, tree):
+        n = len(tree)
+        parent = array.array('i', [row[0] for row in tree])
+        depth = array.array('i', [-1]) * n
+        first_child = array.array('i', [0]) * n
+        num_children = array.array('i', [0]) * n
+        order = array.array('i', [v for v in range(n) if parent[v] < 0])
+        for v in order:
+            depth[v] = 0
+        head = 0
+        while head < len(order):
+            v = order[head]
+            head += 1
+            first_child[v] = len(order)
+            num_children[v] = len(tree[v]) - 1
+            order.extend(tree[v][1:])
+            for w in tree[v][1:]:
+                depth[w] = depth[v] + 1
+        return cls(parent, depth, order, first_child, num_children)
+
+    """Build the forest with the given parents (-1 for a root)"""
+    @classmethod
+    def from_parents(cls, parent):
+        tree = [[p] for p in parent]
+        for v in range(len(parent)):
+            if parent[v] >= 0:
+                tree[parent[v]].append(v)
+        return cls.from_lists(tree)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __getitem__(self, v):
+        return [self.parent[v]] + list(self.children(v))
+
+    def children(self, v):
+        s = self.first_child[v]
+        return list_slice(self.order, s, s + self.num_children[v])
+
+
+"""Breadth-first-search into preallocated arrays
+
+This computes the same forest as bfs_forest, but returns it as a bfs_tree.  The array order doubles as the BFS queue and depth doubles as the set of vertices that have been seen, so no other memory is allocated.
+"""
+def bfs_arrays(succ, roots):
+    n = len(succ)
+    parent = array.array('i', [-1]) * n
+    depth = array.array('i', [-1]) * n
+    first_child = array.array('i', [0]) * n
+    num_children = array.array('i', [0]) * n
+    order = array.array('i', [0]) * n
+    tail = 0
+    for r in reversed(roots):  # the same order as bfs_forest
+        depth[r] = 0
+        order[tail] = r
+        tail += 1
+    head = 0
+    while head < tail:
+        v = order[head]
+        head += 1
+        first_child[v] = tail
+        d = depth[v] + 1
         for w in succ[v]:
-            if w not in seen:
-                seen.add(w)
-                q.appendleft(w)
-                t[w].append(v)  # sets w's parent to v
-                t[v].append(w)  # makes w a child of v
-    return t
+            if depth[w] < 0:
+                depth[w] = d
+                parent[w] = v
+                order[tail] = w
+                tail += 1
+        num_children[v] = tail - first_child[v]
+    del order[tail:]
+    return bfs_tree(parent, depth, order, first_child, num_children)
 
 
 # Unused, more documentation about the the forest representation we use
@@ -209,68 +657,483 @@ class AnonObj(object):
 def free_colour(colours):
     return min(set(range(len(colours)+1)).difference(colours))
 
+"""Statistics about a run of tripod_partition
+
+Pass an instance as the stats argument of tripod_partition (or tripod_partition.stream) to collect these.  Nothing is collected, and nothing costs any time, unless this is done: the counters work by wrapping methods of the partition and of its nearest marked ancestor structure with counting versions, and only the partition being measured is affected.  The attributes are:
+- phases: the time, in seconds, taken by each phase of the computation ('validate', 'bfs', 'nma', 'compute', 'verify' and 'pack', as applicable)
+- sperner_steps: the number of colour lookups made to find the Sperner triangle of each subproblem, in order
+- colour_queries, marks and relabels: the number of get_colour calls (i.e., nearest marked ancestor queries), the number of vertices marked and the number of entries that the integer set rewrote while marking them (for IntegerSet, the total length of the intervals that were split)
+- recolourings: the number of subproblems with an empty third path, which need a vertex of the cycle to be recoloured
+- leg_lengths: a Counter mapping each length to the number of legs (without their feet) with this length
+- subproblem_sizes: for each tripod t > 0, the number of tripods in the subproblem that created it, i.e., in its subtree of the tripod tree (not computed by stream)
+If callback is given, callback(ti, legs, steps) is called each time tripods[ti] is created, where steps is the last entry of sperner_steps.  Only the work done in this process is counted, so with workers > 1 the subproblems solved by workers are missing.
+"""
+class partition_stats(object):
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.phases = dict()
+        self.sperner_steps = array.array('q')
+        self.colour_queries = self.marks = self.relabels = 0
+        self.recolourings = 0
+        self.leg_lengths = collections.Counter()
+        self.subproblem_sizes = array.array('q')
+
+    def _attach(self, tp, worst_case):
+        get_colour = tp.get_colour
+        def counting_get_colour(v):
+            self.colour_queries += 1
+            return get_colour(v)
+        tp.get_colour = counting_get_colour
+
+        name = {'auto': 'sperner_triangle_auto', True: 'sperner_triangle_parallel',
+                False: 'sperner_triangle'}[worst_case]
+        sperner = getattr(tp, name)
+        def counting_sperner(e, *args):
+            before = self.colour_queries
+            tau = sperner(e, *args)
+            self.sperner_steps.append(self.colour_queries - before)
+            return tau
+        setattr(tp, name, counting_sperner)
+
+        nma = tp.nma
+        mark = nma.mark
+        def counting_mark(v):
+            self.marks += 1
+            mark(v)
+        nma.mark = counting_mark
+        intset = nma.intset
+        add = intset.add
+        def counting_add(x):
+            a, b = intset.interval(x)
+            if b > x:
+                self.relabels += min(x-a, b-x)
+            add(x)
+        intset.add = counting_add
+
+    def _start(self):
+        self._time = time.perf_counter()
+
+    def _stop(self, phase):
+        self.phases[phase] = self.phases.get(phase, 0) \
+            + time.perf_counter() - self._time
+
+    def _tripod(self, ti, legs, callback=True):
+        for leg in legs:
+            self.leg_lengths[len(leg)-1] += 1
+        if callback and self.callback is not None:
+            steps = self.sperner_steps[-1] if ti > 0 else 0
+            self.callback(ti, legs, steps)
+
+    def _finish(self, tp, parallel=False):
+        if parallel:
+            # the subproblems solved by workers did not go through _tripod
+            for legs in tp.tripods:
+                self._tripod(-1, legs, callback=False)
+        ends = tp.subtree_ends()
+        self.subproblem_sizes = array.array('q', [ends[t] - t for t in
+                                                  range(1, len(ends))])
+
+    """ Return a human-readable summary of the statistics """
+    def summary(self):
+        lines = list()
+        lines.append("phases: " + ", ".join("{} {:.3f}s".format(k, v)
+                                            for k, v in self.phases.items()))
+        lines.append("sperner steps per subproblem: "
+                     + _describe(self.sperner_steps))
+        lines.append("colour queries: {}  marks: {}  relabels: {}"
+                     .format(self.colour_queries, self.marks, self.relabels))
+        lines.append("recolourings: {}".format(self.recolourings))
+        lines.append("leg lengths: " + _describe(
+            list(itertools.chain.from_iterable(
+                itertools.repeat(length, count)
+                for length, count in sorted(self.leg_lengths.items())))))
+        if self.subproblem_sizes:
+            lines.append("subproblem sizes (tripods): "
+                         + _describe(self.subproblem_sizes))
+        return "\n".join(lines)
+
+""" Summarize a list of numbers as its count, mean and quantiles """
+def _describe(values):
+    if not values:
+        return "none"
+    values = sorted(values)
+    q = lambda p: values[min(len(values)-1, int(p*len(values)))]
+    return "count {}  mean {:.2f}  median {}  p90 {}  p99 {}  max {}".format(
+        len(values), sum(values) / len(values), q(0.5), q(0.9), q(0.99),
+        values[-1])
+
+"""An error in the embedding of a triangulation
+
+Raised by validate_embedding (and so by tripod_partition) and by csr_triangulation.  vertices and faces are lists of the offending vertices and faces (as triples), either of which may be empty.  It is a ValueError, so code that catches ValueError still works.
+"""
+class EmbeddingError(ValueError):
+    def __init__(self, message, vertices=(), faces=()):
+        super().__init__(message)
+        self.vertices = list(vertices)
+        self.faces = list(faces)
+
+""" Check that succ is a planar triangulation with outer face outer_face
+
+    succ is a list of dictionaries or a csr_triangulation, as for
+    tripod_partition.  This checks, in O(n) time, that:
+    - every neighbour is a vertex other than the vertex itself
+    - the neighbours of each vertex form a single cycle of the rotation
+    - every face (u, v, w) = (u, v, succ[u][v]) is also found from v and w,
+      i.e., succ[v][w] = u and succ[w][u] = v, so every edge has a twin
+    - the graph is connected and satisfies Euler's formula, n - m + f = 2,
+      so it is a triangulation of the sphere
+    - outer_face is a face, listed in counterclockwise order
+    Raises EmbeddingError, listing the offending vertices or faces, if any
+    of these fail.
+"""
+def validate_embedding(succ, outer_face):
+    n = len(succ)
+    if n < 3:
+        raise EmbeddingError("a triangulation needs at least 3 vertices")
+    csr = isinstance(succ, csr_triangulation)
+    if csr:
+        offsets, heads, rotation = succ.offsets, succ.heads, succ.rotation
+        if min(heads, default=0) < 0 or max(heads, default=0) >= n:
+            bad = [h for h in range(len(heads)) if not 0 <= heads[h] < n]
+            raise EmbeddingError("neighbours out of range", vertices=sorted(
+                set(bisect.bisect_right(offsets, h) - 1 for h in bad)))
+    else:
+        for d in succ:
+            # the values must be checked too, or a bad one would only show
+            # up as a broken rotation at some other vertex
+            if min(d, default=0) < 0 or max(d, default=0) >= n \
+               or min(d.values(), default=0) < 0 \
+               or max(d.values(), default=0) >= n:
+                raise EmbeddingError("neighbours out of range", vertices=[
+                    u for u in range(n) if any(not 0 <= v < n or
+                                               not 0 <= w < n
+                                               for v, w in succ[u].items())])
+
+    # each rotation must be a single cycle through all the neighbours
+    bad = list()
+    for u in range(n):
+        if csr:
+            lo, hi = offsets[u], offsets[u+1]
+            h, i = lo, 0
+            while i < hi - lo:
+                h = rotation[h]
+                i += 1
+                if not lo <= h < hi or h == lo:
+                    break
+            # heads must be sorted (so distinct) for edge() to work
+            ok = i == hi - lo and h == lo and hi > lo \
+                and all(map(operator.lt, heads[lo:hi-1], heads[lo+1:hi])) \
+                and u not in heads[lo:hi]
+        else:
+            d = succ[u]
+            v = v0 = next(iter(d), None)
+            i = 0
+            while i < len(d):
+                v = d.get(v)
+                i += 1
+                if v is None or v == v0:
+                    break
+            ok = i == len(d) and v == v0 and v0 is not None and u not in d
+        if not ok:
+            bad.append(u)
+    if bad:
+        raise EmbeddingError("rotations that are not a single cycle of "
+                             "distinct neighbours", vertices=bad)
+
+    # Each face must be the same from all three of its vertices.  Checking
+    # that succ[v][w] = u for the face (u, v, w) to the left of every
+    # half-edge uv also checks succ[w][u] = v, from the half-edge vw.
+    if csr:
+        def third(v, w):
+            try:
+                return succ.third(v, w)
+            except KeyError:
+                return None
+    else:
+        third = lambda v, w: succ[v].get(w)
+    bad = list()
+    for u in range(n):
+        if csr:
+            lo, hi = offsets[u], offsets[u+1]
+            items = zip(heads[lo:hi], map(heads.__getitem__, rotation[lo:hi]))
+        else:
+            items = succ[u].items()
+        for v, w in items:
+            if third(v, w) != u:
+                bad.append((u, v, w))
+    if bad:
+        raise EmbeddingError("faces that are not consistent around all "
+                             "their vertices", faces=bad)
+
+    m = (succ.num_half_edges() if csr else sum(map(len, succ))) // 2
+    f = 2 * m // 3
+    if n - m + f != 2:
+        raise EmbeddingError("n - m + f = {} - {} + {} is not 2, so this is "
+                             "not a triangulation of the sphere"
+                             .format(n, m, f))
+    order = bfs_arrays(succ, [0]).order
+    if len(order) < n:
+        seen = bytearray(n)
+        for v in order:
+            seen[v] = 1
+        raise EmbeddingError("the graph is not connected", vertices=[
+            v for v in range(n) if not seen[v]])
+
+    if len(outer_face) != 3 or not all(0 <= v < n for v in outer_face) \
+       or succ[outer_face[0]].get(outer_face[1]) != outer_face[2]:
+        raise EmbeddingError("outer_face is not a counterclockwise face",
+                             faces=[tuple(outer_face)])
+
 """The tripod partition class
 
-This is the object that the algorithm constructs from a planar triangulation.  The input is a planar triangulation with vertex set 0,...,n-1 [where n := len(succ)].  The argument succ is a list of dictionaries so that succ[u][v] is the third vertex w of the triangle uvw that lies to the left of the directed edge uv.  The structure obtained from this is described in the README
+This is the object that the algorithm constructs from a planar triangulation.  The input is a planar triangulation with vertex set 0,...,n-1 [where n := len(succ)].  The argument succ is a list of dictionaries so that succ[u][v] is the third vertex w of the triangle uvw that lies to the left of the directed edge uv, or a csr_triangulation, which stores the same information in flat arrays.  The structure obtained from this is described in the README
 """
 class tripod_partition(object):
-    def __init__(self, succ, outer_face, worst_case=True, verify=True):
-        n = len(succ)
-        td = sum([len(a) for a in succ])
-        m = td // 2
-        f = td // 3
-        assert(m == 3*n -6)
-        assert(f == 2*n - 4)  # redundant, of course
+    # The number of single-walk steps taken when worst_case == 'auto'
+    auto_budget = 64
+
+    def __init__(self, succ, outer_face, worst_case=True, verify=True,
+                 packed=False, prune=False, nma='interval', workers=None,
+                 parallel_depth=None, incremental=False, stats=None,
+                 validate=True):
+        paths = self._setup(succ, outer_face, nma, stats, validate)
+        if incremental:
+            self._options = (worst_case, prune, nma)
+            self._subproblems = [None]
+        if stats is not None:
+            stats._attach(self, worst_case)
+            stats._start()
+        parallel = bool(workers and workers > 1)
+        if parallel:
+            self._compute_parallel(paths, worst_case, prune, nma, workers,
+                                   parallel_depth)
+        else:
+            self._compute(paths, worst_case, prune)
+        if stats is not None:
+            stats._stop('compute')
+            stats._finish(self, parallel)
+
+        # These are used only during the computation
+        del self.index_map, self.index_map2, self.arena
+        del self.nma
+
+        self.packed = False
+        if verify:
+            if stats is not None:
+                stats._start()
+            # only a float is a sample rate; verify=1 means a full check
+            if isinstance(verify, float):
+                self.verify_results(sample=verify)
+            else:
+                self.verify_results(workers=workers)
+            if stats is not None:
+                stats._stop('verify')
+
+        if packed:
+            if stats is not None:
+                stats._start()
+            self.pack()
+            if stats is not None:
+                stats._stop('pack')
+
+    """ Generate the tripods of a partition without storing them
+
+        This is a generator that yields a tuple (ti, parent, r, legs) for
+        each tripod as soon as it is created, where ti is the index of the
+        tripod, parent is the index of its parent in the tripod tree (-1 for
+        the root tripod 0), r is the index of its subtree in the parent,
+        and legs are its three closed legs.  Tripods are yielded in
+        preorder, so ti counts up from 0.  Only O(n) memory is used for the
+        vertex colours and tripod_map, since the tripods themselves are
+        neither stored nor verified.
+    """
+    @classmethod
+    def stream(cls, succ, outer_face, worst_case=True, prune=False,
+               nma='interval', stats=None, validate=True):
+        self = cls.__new__(cls)
+        paths = self._setup(succ, outer_face, nma, stats, validate)
+        yield (0, -1, 0, self.tripods[0])
+        if stats is None:
+            yield from self._generate(paths, worst_case, prune, store=False)
+            return
+        stats._attach(self, worst_case)
+        stats._tripod(0, self.tripods[0])
+        for item in self._generate(paths, worst_case, prune, store=False):
+            stats._tripod(item[0], item[3])
+            yield item
+
+    """ Check the input and initialize the data used by _compute """
+    def _setup(self, succ, outer_face, nma, stats=None, validate=True):
+        if validate:
+            if stats is not None:
+                stats._start()
+            validate_embedding(succ, outer_face)
+            if stats is not None:
+                stats._stop('validate')
 
         self.succ = succ
+        self.stats = stats
+        self.packed = False
 
         roots = outer_face[::-1]
-        self.t = bfs_forest(succ, roots)
-        self.nma = MarkedAncestorStruct(self.t, roots)
+        if stats is not None:
+            stats._start()
+        self.t = bfs_arrays(succ, roots)
+        self.layers = self.t.depth
+        if stats is not None:
+            stats._stop('bfs')
+            stats._start()
+        self.nma = MarkedAncestorStruct(self.t, roots, integer_sets[nma])
+        if stats is not None:
+            stats._stop('nma')
 
         self.tripod_map = [None] * len(succ)
-        self.index_map = [None] * len(succ)  # allows constant time path splits
+        # The paths of every subproblem are list_slices of self.arena, and
+        # index_map and index_map2 are the two positions of each vertex in
+        # it, which allows constant time path splits (see _generate)
+        self.arena = array.array('i', roots)
+        self.index_map = [None] * len(succ)
+        self.index_map2 = [None] * len(succ)
         self.colours = [4] * len(succ)
         for i in range(len(roots)):
             r = roots[i]
             self.tripod_map[r] = (0, i, 0)
-            self.index_map[r] = 0
+            self.index_map[r] = i
             self.set_colour(r, i)
 
-        paths = [list_slice([x]) for x in roots]
+        paths = [list_slice(self.arena, i, i+1) for i in range(len(roots))]
         self.tripods = [[[x, -1] for x in roots]]
-        self.tripod_colours = [0]
-        self.tripod_tree = [[1]]
-
-        self._compute(paths, worst_case)
-
-        # These are used only during the computation
-        del self.index_map
-        del self.nma
-        del self.tripod_colours
-
-        # These checks add about 10% to the runtime
-        if verify:
-            self.verify_results()
+        # the root's only child is set when tripod 1 is stored (it stays
+        # None if tripod 1 is pruned)
+        self.tripod_tree = [[None]]
+        self._tree_index = None  # built on demand by subtree_ends()
+        # with incremental=True, _subproblems[t] is the three paths of the
+        # subproblem in which tripods[t] was created and their colours
+        # at the time (see update)
+        self._subproblems = None
+        return paths
+
+    """ Convert the results into flat arrays
+
+        Replaces tripods, tripod_map and tripod_tree with packed_tripods,
+        packed_triples and packed_tree, respectively.  These use a few bytes
+        per entry instead of a Python object per entry and can still be
+        indexed like the lists they replace.  t is already a bfs_tree, which
+        is stored in flat arrays, so it is kept as it is.
+    """
+    def pack(self):
+        if self.packed:
+            return
+        self.t, self.tripods, self.tripod_map, self.tripod_tree = self._packed()
+        self.packed = True
+
+    """ Return packed versions of t, tripods, tripod_map and tripod_tree """
+    def _packed(self):
+        if self.packed:
+            return self.t, self.tripods, self.tripod_map, self.tripod_tree
+        return (self.t,
+                packed_tripods(packed_lists.from_lists(
+                    itertools.chain.from_iterable(self.tripods))),
+                packed_triples.from_tuples(self.tripod_map),
+                packed_tree.from_lists(self.tripod_tree))
+
+    """ Save the partition to a file
+
+        The file holds t, tripods, tripod_map, tripod_tree and, if
+        include_succ is True and succ is a csr_triangulation (or can be
+        converted to one), succ.  See save_arrays for the file format.
+    """
+    def save(self, path, include_succ=False):
+        save_arrays(path, self._sections(include_succ))
+
+    """ Return the (name, array) sections that save() writes """
+    def _sections(self, include_succ=False):
+        t, tripods, tripod_map, tripod_tree = self._packed()
+        sections = [('t.parent', t.parent), ('t.depth', t.depth),
+                    ('t.order', t.order), ('t.first_child', t.first_child),
+                    ('t.num_children', t.num_children)]
+        sections += [('legs.values', tripods.legs.values),
+                    ('legs.offsets', tripods.legs.offsets),
+                    ('map.tripod', tripod_map.columns[0]),
+                    ('map.leg', tripod_map.columns[1]),
+                    ('map.index', tripod_map.columns[2]),
+                    ('tree', tripod_tree.children)]
+        if include_succ and self.succ is not None:
+            sections.extend(_csr_sections(self.succ))
+        return sections
+
+    """ Load a partition saved with save()
+
+        If use_mmap is True then the file is memory-mapped and the arrays of
+        the result are views into it, so loading takes time independent of
+        the size of the partition.  The result is packed; its succ is None
+        unless it was saved with include_succ=True.
+    """
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        return cls._from_arrays(load_arrays(path, use_mmap))
+
+    """ Build a packed partition from the arrays returned by load_arrays """
+    @classmethod
+    def _from_arrays(cls, a):
+        self = cls.__new__(cls)
+        self._subproblems = None
+        self.t = bfs_tree(a['t.parent'], a['t.depth'], a['t.order'],
+                          a['t.first_child'], a['t.num_children'])
+        self.layers = self.t.depth
+        self.tripods = packed_tripods(packed_lists(a['legs.values'],
+                                                   a['legs.offsets']))
+        self.tripod_map = packed_triples((a['map.tripod'], a['map.leg'],
+                                          a['map.index']))
+        self.tripod_tree = packed_tree(a['tree'])
+        self.succ = None
+        if 'succ.heads' in a:
+            self.succ = csr_triangulation(a['succ.offsets'], a['succ.heads'],
+                                          a['succ.rotation'])
+        self._tree_index = None
+        self.packed = True
+        return self
 
     """ Compute the partition into tripods """
-    def _compute(self, paths, worst_case):
+    def _compute(self, paths, worst_case, prune=False):
+        if self.stats is None:
+            for _ in self._generate(paths, worst_case, prune):
+                pass
+            return
+        self.stats._tripod(0, self.tripods[0])
+        for (ti, _, _, tripod) in self._generate(paths, worst_case, prune):
+            self.stats._tripod(ti, tripod)
+
+    """ Compute the partition into tripods, yielding each new tripod
+
+        Yields (ti, parent, r, tripod) each time tripods[ti] is created.  If
+        store is False then the tripods and tripod_tree are not stored.  If
+        defer is not None then the subproblems of tripods created at a
+        recursion depth of at least defer_depth are not solved. Instead,
+        defer(ti, i0, paths) is called for each of them, in preorder.
+    """
+    def _generate(self, paths, worst_case, prune=False, store=True,
+                  parent=0, r=0, defer=None, defer_depth=0):
+        k = len(self.tripods)  # the number of tripods created so far
         # To avoid recursion we implement our own recursion stack.
         # Each stack frame is a list of up to 3 subproblems. Each subproblem
         # contains the index of the parent tripod, the index of the subproblem
-        # within this tripod, and the three paths that form a cycle containing
-        # the subproblem
-        stack = [[(0, 0, paths)]]
+        # within this tripod, the three paths that form a cycle containing
+        # the subproblem and, if a vertex of the cycle had to be recoloured,
+        # that vertex and its original colour
+        stack = [[(parent, r, paths, None)]]
         nextsubproblem = stack[0][0]
+        arena = self.arena
         while nextsubproblem:
-            (parent, r, paths) = nextsubproblem
-
-            # paths[2] is two entire legs of a tripod
-            for i in range(len(paths[2])):
-                self.index_map[paths[2][i]] = i
+            (parent, r, paths, _) = nextsubproblem
+            if self._subproblems is not None:
+                subproblem = (paths, [self.colours[path[0]] if path else None
+                                      for path in paths])
 
             # paths[0] and paths[1] are always non-empty, but not paths[2]
             if not paths[2]:
+                if self.stats is not None:
+                    self.stats.recolourings += 1
                 # TODO: Handle this case directly, without recolouring
                 cprime = free_colour([self.colours[paths[0][0]],
                                   self.colours[paths[1][0]]])
@@ -279,13 +1142,17 @@ class tripod_partition(object):
                 else: # len(paths[0]) > 1:
                     paths = [paths[0][1:], paths[1], paths[0][:1]]
                 v = paths[2][0]
+                stack[-1][-1] = (parent, r, paths, (v, self.colours[v]))
                 self.colours[v] = cprime
-                stack[-1][-1] = (parent, r, paths)
 
             if worst_case:
-                # this code guarantees O(n log n) running time
                 e = [ (paths[i][-1], paths[(i+1)%3][0]) for i in range(3)]
-                tau = self.sperner_triangle_parallel(e)
+                if worst_case == 'auto':
+                    # a single walk that falls back on the parallel search
+                    tau = self.sperner_triangle_auto(e, self.auto_budget)
+                else:
+                    # this code guarantees O(n log n) running time
+                    tau = self.sperner_triangle_parallel(e)
 
                 # rotate so that tau[i] leads to paths[i]
                 tcols = [self.get_colour(tau[i]) for i in range(3)]
@@ -299,29 +1166,47 @@ class tripod_partition(object):
             # compute the legs of the tripod
             tripod = [self.tripod_path(tau[i]) for i in range(3)]
 
-            # add this tripod to the list of tripods
-            ti = len(self.tripods)
-            self.tripods.append(tripod)
-            self.tripod_tree.append([None]*3)
-            self.tripod_tree[parent][r] = ti
+            # this tripod will be tripods[ti], unless it is pruned below
+            ti = k
 
             # colour the tripod with a colour not used by paths[0,1,2]
             c2 = free_colour([self.get_colour(tau[i]) for i in range(3)])
-            self.tripod_colours.append(c2)
+
+            # The third path of subproblem i is leg i+1 reversed followed by
+            # leg i (without their feet), and it is written to the arena
+            # once, here.  So every open leg appears in the arena twice,
+            # forwards and backwards, and every path that is ever split
+            # is a slice of one of these copies or of the outer face.
+            lens = [len(tripod[i]) - 1 for i in range(3)]
+            starts = [len(arena)] * 4
+            for i in range(3):
+                starts[i+1] = starts[i] + lens[(i+1)%3] + lens[i]
+                if lens[(i+1)%3]:
+                    arena.extend(tripod[(i+1)%3][-2::-1])
+                if lens[i]:
+                    arena.extend(tripod[i][:-1])
 
             # map and colour the vertices in the tripod
             for i in range(3):
                 path = tripod[i]
-                for j in range(len(path)-1):
+                if not lens[i]:
+                    continue
+                forwards = starts[i] + lens[(i+1)%3]
+                backwards = starts[(i+2)%3] + lens[i] - 1
+                for j in range(lens[i]):
                     v = path[j]
                     self.tripod_map[v] = (ti, i, j)
                     self.set_colour(v, c2)
+                    self.index_map[v] = forwards + j
+                    self.index_map2[v] = backwards - j
 
             # Create the 6 paths that appear on the boundaries of subproblems.
             p = list()
             for i in range(3):
                 v = tripod[i][-1]  # tripod leg i attaches to paths[i] at v
                 j = self.index_map[v]  # tells us where v is in paths[i].a
+                if not paths[i].start <= j < paths[i].stop:
+                    j = self.index_map2[v]
                 jprime = paths[i].untranslate(j)
                 assert(paths[i][jprime] == v)
                 # p[i][0] is the prefix of paths[i] up to and including v
@@ -335,9 +1220,28 @@ class tripod_partition(object):
                 q = [None]*3
                 q[0] = p[i][1]
                 q[1] = p[(i+1)%3][0]
-                q[2] = list_slice(tripod[(i+1)%3][-2::-1] + tripod[i][:-1])
+                q[2] = list_slice(arena, starts[i], starts[i+1])
                 if sum([len(q[i]) for i in range(3)]) >= 3:
-                    newframe.append((ti, i0, q))
+                    newframe.append((ti, i0, q, None))
+
+            # add this tripod to the list of tripods. A tripod whose legs
+            # are all feet and that has no subproblems contains no vertices
+            # and is a leaf of the tripod tree, so pruning it does not
+            # affect the preorder numbering of the remaining tripods
+            if newframe or not prune or max(len(leg) for leg in tripod) > 1:
+                k += 1
+                if store:
+                    self.tripods.append(tripod)
+                    self.tripod_tree.append([None]*3)
+                    self.tripod_tree[parent][r] = ti
+                    if self._subproblems is not None:
+                        self._subproblems.append(subproblem)
+                yield (ti, parent, r, tripod)
+
+            if defer is not None and newframe and len(stack) >= defer_depth:
+                for (_, i0, q, _) in newframe:
+                    defer(ti, i0, q)
+                newframe = []
 
             if newframe:
                 # The next iteration is a "recursive" call
@@ -349,18 +1253,420 @@ class tripod_partition(object):
                 nextsubproblem = None
                 while stack and not nextsubproblem:
                     frame = stack[-1]
-                    parent, r, paths = frame.pop()
-                    if len(paths[2]) == 1:
-                        v = paths[2][0]
-                        self.colours[v] = self.tripod_colours[self.tripod_map[v][0]]
+                    parent, r, paths, recoloured = frame.pop()
+                    if recoloured:
+                        v, c = recoloured
+                        self.colours[v] = c
                     if not frame:
                         stack.pop()
                     else:
                         nextsubproblem = frame[-1]
-                # TODO: this creates exactly one tripod for each face of
-                # the input graph. Many of these tripods are useless: they
-                # have no legs and no children. With a bit more work we
-                # could avoid creating these tripods and speedup the code
+                # Unless prune is set, this creates exactly one tripod for
+                # each face of the input graph. Many of these tripods have
+                # no legs and no children.
+
+    """ Compute the partition using a pool of worker processes
+
+        The subproblems of a tripod split the region inside its cycle into
+        regions whose interiors are disjoint, so once the recursion reaches
+        depth parallel_depth, each subproblem is sent to a worker process
+        (see _subproblem_job and _solve_subproblem) while the main process
+        carries on with the rest.  The results are then stitched back in so
+        that the tripods are numbered in preorder, exactly as _compute would
+        have numbered them.
+    """
+    def _compute_parallel(self, paths, worst_case, prune, nma, workers,
+                          parallel_depth):
+        if parallel_depth is None:
+            # aim for a few subproblems per worker
+            parallel_depth = 1
+            while 3**parallel_depth < 4*workers:
+                parallel_depth += 1
+        deferred = collections.defaultdict(list)
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            def defer(ti, i0, q):
+                job = self._subproblem_job(q)
+                future = pool.submit(_solve_subproblem, job, worst_case, prune,
+                                     nma, self.auto_budget,
+                                     self._subproblems is not None)
+                deferred[ti].append((i0, future))
+            for _ in self._generate(paths, worst_case, prune, defer=defer,
+                                    defer_depth=parallel_depth+1):
+                pass
+            results = {ti: [(i0, future.result()) for (i0, future) in jobs]
+                       for (ti, jobs) in deferred.items()}
+        self._stitch(results)
+
+    """ Return the data a worker needs to solve the subproblem with paths
+
+        The subproblem is the part of G inside the cycle formed by paths,
+        which lies to the left of each edge of the cycle.  Its faces are
+        found by a search that never crosses an edge of the cycle.
+        Returns the three paths, the colours of their vertices, the faces
+        of the subproblem (flattened) and its interior vertices together
+        with their parents in the BFS tree.  The vertices of each path have
+        the same colour, which is taken from colours[i] for path i if
+        colours is given and from self.colours otherwise.
+    """
+    def _subproblem_job(self, paths, colours=None):
+        paths = [list(path) for path in paths]
+        cycle = paths[0] + paths[1] + paths[2]
+        walls = set(zip(cycle, cycle[1:] + cycle[:1]))
+        on_cycle = set(cycle)
+        faces = list()
+        seen = set()
+        interior = list()
+        stack = [(paths[0][-1], paths[1][0])]
+        while stack:
+            u, v = stack.pop()
+            w = self.succ[u][v]
+            face = min((u, v, w), (v, w, u), (w, u, v))
+            if face in seen:
+                continue
+            seen.add(face)
+            faces.extend(face)
+            for (a, b) in ((u, v), (v, w), (w, u)):
+                if (a, b) not in walls:
+                    stack.append((b, a))
+                if a not in on_cycle:
+                    on_cycle.add(a)
+                    interior.append(a)
+        if colours is None:
+            colours = [self.colours[v] for v in cycle]
+        else:
+            colours = [c for (path, c) in zip(paths, colours) for _ in path]
+        parents = [self.t.parent[v] for v in interior]
+        return paths, colours, faces, interior, parents
+
+    """ Renumber the tripods after _compute_parallel
+
+        results[ti] is a list of (i0, result) pairs, one for each subproblem
+        of tripod ti that was solved by a worker, where result is returned by
+        _solve_subproblem.  The tripods of each of these come immediately
+        after ti in preorder.
+    """
+    def _stitch(self, results):
+        k = len(self.tripods)
+        new_id = [None]*k
+        tripods = list()
+        tree = list()
+        subproblems = list()
+        children = list()  # (tripod, i0, first tripod of its subproblem)
+        for t in range(k):
+            new_id[t] = len(tripods)
+            tripods.append(self.tripods[t])
+            tree.append(None)  # filled in below, once new_id is known
+            if self._subproblems is not None:
+                subproblems.append(self._subproblems[t])
+            for (i0, result) in results.get(t, []):
+                legs, subtree = result[:2]
+                start = len(tripods)
+                if legs:
+                    children.append((t, i0, start))
+                tripods.extend(legs)
+                if self._subproblems is not None:
+                    subproblems.extend(result[2])
+                # the tripods of subtree are numbered from 1
+                tree.extend([[start+c-1 if c is not None else None
+                              for c in row] for row in subtree])
+        for t in range(k):
+            tree[new_id[t]] = [new_id[c] if c is not None else None
+                               for c in self.tripod_tree[t]]
+        for (t, i0, start) in children:
+            tree[new_id[t]][i0] = start
+        for v in range(len(self.tripod_map)):
+            if self.tripod_map[v] is not None:
+                (t, i, j) = self.tripod_map[v]
+                self.tripod_map[v] = (new_id[t], i, j)
+        for ti in range(len(tripods)):
+            for i in range(3):
+                leg = tripods[ti][i]
+                for j in range(len(leg)-1):
+                    if self.tripod_map[leg[j]] is None:
+                        self.tripod_map[leg[j]] = (ti, i, j)
+        self.tripods = tripods
+        self.tripod_tree = tree
+        if self._subproblems is not None:
+            self._subproblems = subproblems
+
+    """ Update the partition after a batch of local edits
+
+        This needs a partition computed with incremental=True.  flips is a
+        list of edges (u, v) to flip: if uvx and vuy are the faces on either
+        side of uv then uv is replaced by xy.  insertions is a list of faces
+        (a, b, c) (with succ[a][b] == c), into each of which a new vertex is
+        inserted and joined to a, b and c.  The new vertices are numbered
+        n, n+1, ... in order.  The edits are applied to self.succ in place
+        (a csr_triangulation is first converted to a list of dicts) and may
+        not touch the outer face.  If any edit is invalid, a ValueError is
+        raised after the edits before it have been undone, so self.succ
+        and the partition are left as they were.
+
+        The BFS forest is recomputed, keeping the parent of each vertex if
+        it is still valid.  Each edit lies inside the subproblem of the
+        lowest common ancestor of the tripods of its vertices in the tripod
+        tree, and each vertex whose parent changed lies inside the
+        subproblem of its own tripod.  The subtree rooted at such a tripod
+        c is the partition of a subproblem bounded by the legs of the
+        ancestors of c, which did not change, so the topmost of these
+        tripods root disjoint subtrees, and only their subproblems are
+        solved again (as in _solve_subproblem) and spliced in place of the
+        tripods c,...,ends[c]-1.  If one of them is the root, or together
+        they have more than half of the tripods, the whole partition is
+        recomputed.
+
+        Returns (new_vertices, replaced, (lo, hi)): the new vertices, the
+        list of ranges (first, end) of old tripods that were replaced, in
+        increasing order, and the range of BFS layers containing vertices
+        that were edited, or whose parent or depth changed.  The result is
+        a valid tripod partition, but it need not be the one that
+        tripod_partition would compute from scratch.
+    """
+    def update(self, flips=(), insertions=(), verify=False):
+        if self._subproblems is None:
+            raise ValueError("update needs a partition computed with "
+                             "incremental=True")
+        if self.packed:
+            raise ValueError("update needs an unpacked partition")
+        if isinstance(self.succ, csr_triangulation):
+            self.succ = self.succ.to_succ()
+        n0 = len(self.succ)
+        roots = [leg[0] for leg in self.tripods[0]]
+        outer_face = roots[::-1]
+        outer = set(zip(outer_face, outer_face[1:] + outer_face[:1]))
+        k = len(self.tripods)
+        ends = self.subtree_ends()
+        tree_parents = self.tree_parents()
+        # the tripod whose subproblem contains each new vertex
+        home = dict()
+        def tripod(v):
+            return self.tripod_map[v][0] if v < n0 else home[v]
+        def lca(vertices):
+            ts = [tripod(v) for v in vertices]
+            c, last = min(ts), max(ts)
+            while ends[c] <= last:
+                c = tree_parents[c]
+            return c
+        touched = set()
+        tops = set()
+        new_vertices = list()
+        # (u, v, w) for each entry succ[u][v] that the edits overwrote, with
+        # w = None if it was absent, so that a bad edit can be rolled back
+        undo = list()
+        try:
+            for (u, v) in flips:
+                edited = self._flip(u, v, outer, undo)
+                touched.update(edited)
+                tops.add(lca(edited))
+            for (a, b, c) in insertions:
+                edited = self._insert(a, b, c, outer, undo)
+                touched.update(edited)
+                w = len(self.succ) - 1
+                home[w] = lca(edited)
+                tops.add(home[w])
+                new_vertices.append(w)
+        except ValueError:
+            for (u, v, w) in reversed(undo):
+                if w is None:
+                    self.succ[u].pop(v, None)
+                else:
+                    self.succ[u][v] = w
+            del self.succ[n0:]
+            raise
+        n = len(self.succ)
+        self.tripod_map.extend([None] * (n - n0))
+        self.colours.extend([4] * (n - n0))
+
+        # a BFS tree that keeps as many of the old parents as possible
+        fresh = bfs_arrays(self.succ, roots)
+        depth = fresh.depth
+        parent = array.array('i', fresh.parent)
+        old = self.t.parent
+        old_depth = self.t.depth
+        layers = set(depth[v] for v in touched)
+        layers.update(depth[v] for v in new_vertices)
+        for v in range(n0):
+            p = old[v]
+            if p != parent[v]:
+                if p >= 0 and p in self.succ[v] and depth[p] == depth[v]-1:
+                    parent[v] = p
+                else:
+                    tops.add(self.tripod_map[v][0])
+                    layers.add(depth[v])
+            if old_depth[v] != depth[v]:
+                layers.add(old_depth[v])
+                layers.add(depth[v])
+        self.t = bfs_tree.from_parents(parent)
+        self.layers = self.t.depth
+        lo = min(layers, default=0)
+        hi = max(layers, default=-1) + 1
+
+        # the topmost tripods root disjoint subtrees
+        replaced = list()
+        for c in sorted(tops):
+            if not replaced or c >= replaced[-1][1]:
+                replaced.append((c, ends[c]))
+        # solving a subproblem has some overhead, so if the subproblems
+        # are most of the partition then it is faster to start from scratch
+        size = sum(end - c for (c, end) in replaced)
+        if replaced and (replaced[0][0] == 0 or 2*size > k):
+            worst_case, prune, nma = self._options
+            # the edits were checked as they were applied
+            paths = self._setup(self.succ, outer_face, nma, validate=False)
+            self._subproblems = [None]
+            self._compute(paths, worst_case, prune)
+            del self.index_map, self.index_map2, self.arena
+            del self.nma
+            replaced = [(0, k)]
+        elif replaced:
+            worst_case, prune, nma = self._options
+            results = list()
+            for (c, end) in replaced:
+                job = self._subproblem_job(*self._subproblems[c])
+                results.append((c, _solve_subproblem(
+                    job, worst_case, prune, nma, self.auto_budget, True)))
+            self._splice(results)
+        if verify:
+            self.verify_results()
+        return new_vertices, replaced, (lo, hi)
+
+    """ Flip the edge uv and return the vertices of the two faces
+
+        Each entry of succ that is changed is first recorded in undo, as in
+        update.
+    """
+    def _flip(self, u, v, outer, undo):
+        succ = self.succ
+        if not (0 <= u < len(succ) and 0 <= v < len(succ)) or v not in succ[u]:
+            raise ValueError("{} is not an edge".format((u, v)))
+        if (u, v) in outer or (v, u) in outer:
+            raise ValueError("cannot flip {}, which is on the outer face"
+                             .format((u, v)))
+        x = succ[u][v]
+        y = succ[v][u]
+        if x == y or y in succ[x]:
+            raise ValueError("flipping {} would create a multiple edge"
+                             .format((u, v)))
+        undo.append((u, v, x))
+        undo.append((v, u, y))
+        del succ[u][v]
+        del succ[v][u]
+        # the faces uvx and vuy become xuy and yvx
+        for (a, b, c) in ((x, u, y), (u, y, x), (y, x, u),
+                          (y, v, x), (v, x, y), (x, y, v)):
+            undo.append((a, b, succ[a].get(b)))
+            succ[a][b] = c
+        return (u, v, x, y)
+
+    """ Insert a new vertex in the face abc and return a, b and c
+
+        As in _flip, each entry of succ that is changed is recorded in undo.
+        The new row itself is not, since update rolls back by truncating
+        succ.
+    """
+    def _insert(self, a, b, c, outer, undo):
+        succ = self.succ
+        if not all(0 <= x < len(succ) for x in (a, b, c)) \
+           or succ[a].get(b) != c:
+            raise ValueError("{} is not a face".format((a, b, c)))
+        if (a, b) in outer or (b, c) in outer or (c, a) in outer:
+            raise ValueError("cannot insert into the outer face")
+        w = len(succ)
+        succ.append(dict())
+        for (x, y) in ((a, b), (b, c), (c, a)):
+            undo.append((x, y, succ[x][y]))
+            undo.append((y, w, None))
+            succ[x][y] = w
+            succ[y][w] = x
+            succ[w][x] = y
+        return (a, b, c)
+
+    """ Replace the tripods c,...,ends[c]-1 with those of a subproblem
+
+        results lists (c, (legs, tree, subproblems)) for disjoint subtrees
+        in increasing order of c, where legs, tree and subproblems are
+        returned by _solve_subproblem, with tree numbered so that its first
+        tripod is 1.  The other tripods are renumbered in a single pass.
+    """
+    def _splice(self, results):
+        ends = self.subtree_ends()
+        tree_parents = self.tree_parents()
+        # bounds[i] is the end of the i-th replaced subtree and shifts[i]
+        # is how far the tripods after it move
+        bounds, shifts = [], []
+        empty = set()
+        shift = 0
+        for (c, (legs, tree, subproblems)) in results:
+            shift += len(legs) - (ends[c] - c)
+            bounds.append(ends[c])
+            shifts.append(shift)
+            if not legs:
+                empty.add(c)
+        def renumber(x):
+            if x is None or x in empty:
+                return None
+            i = bisect.bisect_right(bounds, x)
+            return x + shifts[i-1] if i else x
+        rows, tripods, subs = [], [], []
+        starts = list()
+        pos = 0
+        for (c, (legs, tree, subproblems)) in results:
+            rows.extend([renumber(x) for x in row]
+                        for row in self.tripod_tree[pos:c])
+            tripods.extend(self.tripods[pos:c])
+            subs.extend(self._subproblems[pos:c])
+            base = len(tripods)
+            starts.append(base)
+            rows.extend([base+x-1 if x is not None else None for x in row]
+                        for row in tree)
+            tripods.extend(legs)
+            subs.extend(subproblems)
+            pos = ends[c]
+        rows.extend([renumber(x) for x in row]
+                    for row in self.tripod_tree[pos:])
+        tripods.extend(self.tripods[pos:])
+        subs.extend(self._subproblems[pos:])
+        self.tripod_tree = rows
+        self.tripods = tripods
+        self._subproblems = subs
+        if any(shifts) or empty:
+            # the vertices of the replaced tripods are mapped again below
+            tripod_map = self.tripod_map
+            for v in range(len(tripod_map)):
+                x = tripod_map[v]
+                if x is not None:
+                    t = renumber(x[0])
+                    if t != x[0]:
+                        tripod_map[v] = (t, x[1], x[2])
+        for (base, (c, (legs, tree, subproblems))) in zip(starts, results):
+            for t in range(base, base+len(legs)):
+                for i in range(3):
+                    leg = tripods[t][i]
+                    for j in range(len(leg)-1):
+                        self.tripod_map[leg[j]] = (t, i, j)
+        self._tree_index = None
+
+    """ Return the partition restricted to the vertices 0,...,n-1
+
+        This is for partitions computed by partition_plane_graph, which
+        adds the vertices n, n+1, ....  Returns (tripods, tripod_map,
+        layers), where tripods[t][i] lists the vertices of the open leg i
+        of tripod t that are less than n (without its foot), tripod_map[v]
+        = (t, i, j) gives the position of v in these lists and layers[v] is
+        the layer of v, for v < n.  The tripods are numbered as in self, so
+        h3parents and h8parents apply to them unchanged.
+    """
+    def restrict(self, n):
+        tripods = list()
+        tripod_map = [None] * n
+        for t, tripod in enumerate(self.tripods):
+            legs = [[v for v in itertools.islice(leg, len(leg)-1) if v < n]
+                    for leg in tripod]
+            for i, leg in enumerate(legs):
+                for j, v in enumerate(leg):
+                    tripod_map[v] = (t, i, j)
+            tripods.append(legs)
+        return tripods, tripod_map, self.layers[:n]
 
     """ Return the parents of tripod t
 
@@ -381,31 +1687,427 @@ class tripod_partition(object):
     def h8parents(self, t, i):
         # (t, i) has i parents in tripod t
         parents = [(t, j) for j in range(i)]
+        parents.extend(self._h8tripod_parents(t))
+        return parents
+
+    """ Return the legs of other tripods that are parents of legs of t """
+    def _h8tripod_parents(self, t):
+        if t == 0:
+            return []
         # tripod 1 is adjacent to all three legs of the root
         if t == 1:
-            parents.extend([(0, j) for j in range(3)])
-            return parents
-        # for t > 1, (t, i) is adjacent to two legs of each h3-parent of t
-        for p in set(self.h3parents(t)):
+            return [(0, j) for j in range(3)]
+        # for t > 1, each leg of t is adjacent to two legs of each h3-parent
+        ends = self.subtree_ends()
+        parents = list()
+        seen = list()
+        for leg in self.tripods[t]:
+            p = self.tripod_map[leg[-1]][0]
+            if p in seen:
+                continue
+            seen.append(p)
             # Tricky: leg j of tripod 1 always attaches to leg j of tripod 0,
             # so if (t, i) is not adjacent to (1, j), then it's not adjacent
             # to (0, j)
-            pp = max(p, 1)
+            children = self.tripod_tree[max(p, 1)]
             # This uses the fact that a the tripods are numbered by
             # the order they're encountered in a pre-order traversal of
-            # self.tripod_tree.
-            indexer = self.tripod_tree[pp] + [len(self.tripods)]
-            for j in range(len(indexer)-1, -1, -1):
-                if indexer[j]:
-                    m = indexer[j]
-                else:
-                    indexer[j] = m
+            # self.tripod_tree, so subtree j of p is a range of tripods
             j = 0
-            while indexer[j] > t or indexer[j+1] <= t:
+            while children[j] is None or not children[j] <= t < ends[children[j]]:
                 j += 1
             parents.extend([(p, k) for k in range(3) if k != j])
         return parents
 
+    """ Return the parent of each tripod in the tripod tree (-1 for the root) """
+    def tree_parents(self):
+        if self._tree_index is None:
+            self._build_tree_index()
+        return self._tree_index[0]
+
+    """ Return the end of the range of tripods in each subtree
+
+        Because tripods are numbered in preorder, the subtree rooted at t
+        is the range of tripods t,...,ends[t]-1, where ends = subtree_ends().
+        So tripod a is in the subtree rooted at t iff t <= a < ends[t].
+    """
+    def subtree_ends(self):
+        if self._tree_index is None:
+            self._build_tree_index()
+        return self._tree_index[1]
+
+    def _build_tree_index(self):
+        k = len(self.tripod_tree)
+        parents = array.array('i', [-1]) * k
+        ends = array.array('i', range(1, k+1))
+        for t in range(k-1, -1, -1):
+            for c in self.tripod_tree[t]:
+                if c is not None:
+                    parents[c] = t
+                    ends[t] = max(ends[t], ends[c])
+        self._tree_index = (parents, ends)
+
+    """ Return a width-3 tree decomposition of h3
+
+        Returns (parent, offsets, bags).  The decomposition tree is the
+        tripod tree, so parent[t] is the parent of tripod t (-1 for the
+        root).  The bag of tripod t is bags[offsets[t]:offsets[t+1]], which
+        contains t followed by the distinct elements of h3parents(t).  This
+        runs in O(k) time, where k = len(self.tripods).
+    """
+    def h3decomposition(self):
+        k = len(self.tripods)
+        offsets = array.array('q', [0, 1])
+        bags = array.array('i', [0])
+        for t in range(1, k):
+            bags.append(t)
+            for leg in self.tripods[t]:
+                p = self.tripod_map[leg[-1]][0]
+                if p not in bags[offsets[-1]+1:]:
+                    bags.append(p)
+            offsets.append(len(bags))
+        return self.tree_parents(), offsets, bags
+
+    """ Return a width-8 tree decomposition of h8
+
+        Leg i of tripod t is represented by the integer 3*t+i.  Returns
+        (parent, offsets, bags) where parent[3*t+i] is the parent of the bag
+        of leg (t, i) in the decomposition tree: (t, i-1) if i > 0 and leg 2
+        of the parent of t in the tripod tree if i == 0.  The bag of (t, i)
+        is bags[offsets[3*t+i]:offsets[3*t+i+1]], which contains 3*t+i
+        followed by the legs in h8parents(t, i).  This runs in O(k) time.
+    """
+    def h8decomposition(self):
+        k = len(self.tripods)
+        tree_parents = self.tree_parents()
+        parent = array.array('i', [-1]) * (3*k)
+        offsets = array.array('q', [0])
+        bags = array.array('i')
+        for t in range(k):
+            legs = [3*p+j for (p, j) in self._h8tripod_parents(t)]
+            for i in range(3):
+                if i > 0:
+                    parent[3*t+i] = 3*t+i-1
+                elif t > 0:
+                    parent[3*t] = 3*tree_parents[t]+2
+                bags.append(3*t+i)
+                bags.extend(range(3*t, 3*t+i))
+                bags.extend(legs)
+                offsets.append(len(bags))
+        return parent, offsets, bags
+
+    """ Return the product structure coordinates of every vertex
+
+        Returns arrays (h, layer) of length n such that vertex v is mapped to
+        the vertex (h[v], layer[v]) of H⊠P, where P is the path of BFS layers.
+        If h8 is False then H is h3 and h[v] is the tripod containing v.  If h8
+        is True then H is h8 and h[v] = 3*t+i, where v is in leg i of tripod t.
+    """
+    def product_coordinates(self, h8=False):
+        if self.packed:
+            tripod, leg = self.tripod_map.columns[0], self.tripod_map.columns[1]
+        else:
+            tripod = [x[0] for x in self.tripod_map]
+            leg = [x[1] for x in self.tripod_map]
+        if h8:
+            h = array.array('i', [3*t+i for t, i in zip(tripod, leg)])
+        else:
+            h = array.array('i', tripod)
+        return h, self.layers
+
+    """ Return the subgraph of H⊠P induced by the occupied cells
+
+        A cell (x, l) of H⊠P is occupied if some vertex has coordinates
+        (x, l), as given by product_coordinates(h8).  Two distinct cells (x, l)
+        and (y, m) are adjacent if |l-m| <= 1 and x = y or xy is an edge of
+        the chordal supergraph of H given by its tree decomposition.  Every
+        edge of G joins two vertices in equal or adjacent cells.
+
+        Returns (cell_h, cell_layer, vertex_cell, tails, heads), all arrays.
+        Cells are numbered in lexicographic order of (x, l), cell c is
+        (cell_h[c], cell_layer[c]), and vertex v is in cell vertex_cell[v].
+        The edges are (tails[j], heads[j]) and each appears once.  This runs
+        in O(n) time, excluding sorting the cells.
+    """
+    def product_graph(self, h8=False):
+        h, layers = self.product_coordinates(h8)
+        n = len(h)
+        width = max(layers) + 2 if n > 0 else 1
+        keys = sorted(set(x*width + l for x, l in zip(h, layers)))
+        cell_index = {key: c for c, key in enumerate(keys)}
+        cell_h = array.array('i', [key // width for key in keys])
+        cell_layer = array.array('i', [key % width for key in keys])
+        vertex_cell = array.array('i', [cell_index[x*width + l]
+                                        for x, l in zip(h, layers)])
+
+        _, offsets, bags = self.h8decomposition() if h8 \
+            else self.h3decomposition()
+        tails = array.array('i')
+        heads = array.array('i')
+        for c, key in enumerate(keys):
+            x, l = divmod(key, width)
+            # the cell above c in the same column, if it is occupied
+            if key+1 in cell_index:
+                tails.append(c)
+                heads.append(cell_index[key+1])
+            # bags[offsets[x]] is x, the rest are the neighbours y < x of x
+            for y in bags[offsets[x]+1:offsets[x+1]]:
+                for m in range(max(l-1, 0), l+2):
+                    d = cell_index.get(y*width + m)
+                    if d is not None:
+                        tails.append(c)
+                        heads.append(d)
+        return cell_h, cell_layer, vertex_cell, tails, heads
+
+    """ Generate the tree decomposition of G induced by h3 or h8
+
+        Each node x of h3decomposition() (or h8decomposition(), if h8 is
+        True) becomes a bag of vertices of G: the vertices of the open
+        tripods (or legs) in the bag of x.  If layers = (lo, hi) is given,
+        the bags only contain the vertices v with lo <= self.layers[v] < hi,
+        which gives a tree decomposition of the subgraph of G induced by
+        these layers whose bags have at most 12(hi-lo) vertices (or 9(hi-lo)
+        for h8).  Yields (x, parent of x, bag) for each node x, one at a time.
+    """
+    def tree_decomposition(self, h8=False, layers=None):
+        parent, offsets, bags = self.h8decomposition() if h8 \
+            else self.h3decomposition()
+        return self._g_bags(parent, offsets, bags, h8, layers)
+
+    def _g_bags(self, parent, offsets, bags, h8, layers):
+        lo, hi = layers if layers is not None else (0, len(self.layers))
+        layer = self.layers
+        tripods = self.tripods
+        for x in range(len(parent)):
+            bag = list()
+            for y in bags[offsets[x]:offsets[x+1]]:
+                legs = [tripods[y//3][y%3]] if h8 else tripods[y]
+                for leg in legs:
+                    for j in range(len(leg)-1):  # leg[-1] is the foot
+                        v = leg[j]
+                        if lo <= layer[v] < hi:
+                            bag.append(v)
+            yield x, parent[x], bag
+
+    """ Write tree_decomposition(h8, layers) to out in PACE .td format
+
+        Bags are written as they are generated, so only one bag is held in
+        memory at a time.  The header needs the largest bag size, which is
+        found in a first pass that only counts vertices.  Vertices are
+        numbered 1,2,... in increasing order of their index in G, and bag
+        x is numbered x+1.  Returns an array whose i-th entry is the vertex
+        of G numbered i+1, which is range(n) unless layers is given.
+    """
+    def write_td(self, out, h8=False, layers=None):
+        lo, hi = layers if layers is not None else (0, len(self.layers))
+        h, layer = self.product_coordinates(h8)
+        vertices = array.array('i', [v for v in range(len(layer))
+                                     if lo <= layer[v] < hi])
+        number = array.array('i', [0]) * len(layer)
+        for i, v in enumerate(vertices):
+            number[v] = i+1
+
+        parent, offsets, bags = self.h8decomposition() if h8 \
+            else self.h3decomposition()
+        count = array.array('i', [0]) * len(parent)
+        for v in vertices:
+            count[h[v]] += 1
+        width = max(sum(count[y] for y in bags[offsets[x]:offsets[x+1]])
+                    for x in range(len(parent)))
+
+        out.write("s td {} {} {}\n".format(len(parent), width, len(vertices)))
+        for x, _, bag in self._g_bags(parent, offsets, bags, h8, layers):
+            out.write("b {}{}\n".format(x+1,
+                      "".join(" {}".format(number[v]) for v in bag)))
+        for x in range(len(parent)):
+            if parent[x] >= 0:
+                out.write("{} {}\n".format(parent[x]+1, x+1))
+        return vertices
+
+    """ Return the adjacency labelling of G given by h8 and the layers
+
+        See adjacency_labelling.  This needs self.succ, so a partition that
+        was loaded from a file must have been saved with include_succ=True.
+    """
+    def adjacency_labels(self):
+        if self.succ is None:
+            raise ValueError("adjacency labels need the graph, "
+                             "save the partition with include_succ=True")
+        h, layer = self.product_coordinates(h8=True)
+        _, offsets, bags = self.h8decomposition()
+        n = len(h)
+        labels = array.array('i', [-1]) * (LABEL_WORDS*n)
+        for v in range(n):
+            x, l = h[v], layer[v]
+            parents = bags[offsets[x]+1:offsets[x+1]]
+            mask = 0
+            for w in self.succ[v]:
+                if h[w] < x:
+                    mask |= 1 << (3*parents.index(h[w]) + layer[w] - l + 1)
+            base = LABEL_WORDS*v
+            labels[base] = x
+            labels[base+1] = l
+            labels[base+2] = mask
+            labels[base+3:base+3+len(parents)] = parents
+        return adjacency_labelling(labels)
+
+    """ Return the open vertices of tripod t, i.e., its legs without feet """
+    def tripod_vertices(self, t):
+        return [leg[j] for leg in self.tripods[t] for j in range(len(leg)-1)]
+
+    """ Return a balanced separator of G and the components it leaves
+
+        The separator consists of every d-th BFS layer, for d about sqrt(n)
+        and the offset that gives the fewest vertices, plus, if the largest
+        slab between two of these layers still has more than n/2 vertices,
+        the vertices in that slab of the tripods in the h3 bag of a weighted
+        centroid of the tripod tree.  Each leg has at most one vertex per
+        layer, so this has O(sqrt(n)) vertices.  Returns (separator,
+        component) where component[v] is -1 for each v in separator and
+        otherwise numbers the connected component of G - separator that
+        contains v.  Each component has at most n/2 vertices.  This needs
+        self.succ and runs in O(n) time.
+    """
+    def separator(self):
+        if self.succ is None:
+            raise ValueError("a separator needs the graph, "
+                             "save the partition with include_succ=True")
+        layer = self.layers
+        n = len(layer)
+        depth = max(layer) + 1
+        d = max(1, int(n ** 0.5))
+        counts = array.array('i', [0]) * depth
+        for l in layer:
+            counts[l] += 1
+        r = min(range(d), key=lambda r: sum(counts[r::d]))
+        # layer l is cut if l % d == r, the others are in slab (l-r+d)//d
+        slabs = array.array('i', [0]) * ((depth-r+d)//d + 1)
+        for l in range(depth):
+            if l % d != r:
+                slabs[(l-r+d)//d] += counts[l]
+        heavy = max(range(len(slabs)), key=slabs.__getitem__)
+
+        removed = bytearray(n)
+        for v in range(n):
+            if layer[v] % d == r:
+                removed[v] = True
+        if 2*slabs[heavy] > n:
+            in_slab = lambda v: layer[v] % d != r and (layer[v]-r+d)//d == heavy
+            weights = [sum(1 for v in self.tripod_vertices(t) if in_slab(v))
+                       for t in range(len(self.tripods))]
+            c = self._centroid(weights)
+            for t in [c] + self.h3parents(c):
+                for v in self.tripod_vertices(t):
+                    if in_slab(v):
+                        removed[v] = True
+        separator = array.array('i', [v for v in range(n) if removed[v]])
+
+        component = array.array('i', [-1]) * n
+        count = 0
+        for s in range(n):
+            if removed[s] or component[s] >= 0:
+                continue
+            component[s] = count
+            queue = [s]
+            for v in queue:
+                for w in self.succ[v]:
+                    if not removed[w] and component[w] < 0:
+                        component[w] = count
+                        queue.append(w)
+            count += 1
+        return separator, component
+
+    """ Return a weighted centroid of the tripod tree
+
+        Returns a tripod c such that each component of the tripod tree minus
+        c has total weight at most half the total weight.
+    """
+    def _centroid(self, weights):
+        tree_parents = self.tree_parents()
+        sub = list(weights)
+        for t in range(len(sub)-1, 0, -1):
+            sub[tree_parents[t]] += sub[t]
+        c = 0
+        while True:
+            heavy = [x for x in self.tripod_tree[c]
+                     if x is not None and 2*sub[x] > sub[0]]
+            if not heavy:
+                return c
+            c = heavy[0]
+
+    """ Return a recursive separator hierarchy of G
+
+        This is a centroid decomposition of the tripod tree: the separator of
+        the root is the h3 bag of a centroid c of the tripod tree, weighted
+        by the number of vertices of each open tripod, and the children of
+        the root are the hierarchies of the components of the tripod tree
+        minus c.  Each separator only contains the vertices that are not in
+        the separator of an ancestor, and if u and v are adjacent then the
+        nodes whose separators contain u and v are equal, or one is an
+        ancestor of the other.  The hierarchy has depth O(log n).
+
+        Returns (parent, offsets, vertices, order), where parent[x] is the
+        parent of node x (-1 for the root), the separator of node x is
+        vertices[offsets[x]:offsets[x+1]] and order is a nested dissection
+        ordering: each separator comes after the separators of all its
+        descendants, and each subtree of the hierarchy is contiguous.  This
+        runs in O(n + k log k) time, where k = len(self.tripods).
+    """
+    def separator_hierarchy(self):
+        k = len(self.tripods)
+        weights = array.array('i', [len(self.tripod_vertices(t))
+                                    for t in range(k)])
+        parent, node_offsets, tripods = \
+            _centroid_decomposition(*self.h3decomposition(), weights)
+        offsets = array.array('q', [0])
+        vertices = array.array('i')
+        for x in range(len(parent)):
+            for t in tripods[node_offsets[x]:node_offsets[x+1]]:
+                vertices.extend(self.tripod_vertices(t))
+            offsets.append(len(vertices))
+        order = array.array('i')
+        for x in range(len(parent)-1, -1, -1):
+            order.extend(vertices[offsets[x]:offsets[x+1]])
+        return parent, offsets, vertices, order
+
+    """ Return a p-centred colouring of G
+
+        A colouring is p-centred if every connected subgraph that has at
+        most p colours has some colour that appears exactly once in it.
+        This combines a vertex ranking r of h8, from a centroid
+        decomposition of h8decomposition(), with the layers: vertex v in
+        leg x gets colour r[x]*(p+1) + layers[v] % (p+1).  A connected
+        subgraph with at most p colours spans at most p consecutive layers,
+        and each leg has at most one vertex per layer, so the vertex in the
+        leg of highest rank has a unique colour.  This uses O(p log n)
+        colours and returns them as an array.
+    """
+    def centred_colouring(self, p):
+        h, layer = self.product_coordinates(h8=True)
+        ranks = self._h8ranks()
+        return array.array('i', [ranks[h[v]]*(p+1) + layer[v] % (p+1)
+                                 for v in range(len(h))])
+
+    def _h8ranks(self):
+        k = len(self.tripods)
+        weights = array.array('i', [len(self.tripods[x//3][x%3]) - 1
+                                    for x in range(3*k)])
+        return _hierarchy_ranks(*_centroid_decomposition(
+            *self.h8decomposition(), weights), 3*k)
+
+    """ Return a vertex ranking of G
+
+        A vertex ranking is a colouring by integers in which every path
+        between two vertices of the same rank contains a vertex of higher
+        rank.  This gives the vertices of each separator in
+        separator_hierarchy() distinct ranks, and ranks the separators of
+        each level of the hierarchy above those of the levels below it.
+        Returns the ranks as an array.
+    """
+    def vertex_ranking(self):
+        parent, offsets, vertices, _ = self.separator_hierarchy()
+        return _hierarchy_ranks(parent, offsets, vertices, len(self.layers))
+
     """ Return a proper 4-colouring of the tripods """
     def colour_tripods(self):
         tripod_colours = [0]
@@ -415,54 +2117,116 @@ class tripod_partition(object):
             tripod_colours.append(c)
         return tripod_colours
 
-    def verify_results(self):
-        # First make sure the tripods form a partition
-        vertices = set()
-        for tripod in self.tripods:
-            for path in tripod:
-                for i in range(len(path)-1):
-                    v = path[i]
-                    assert(v not in vertices)
-                    vertices.add(v)
-
-        # Check the graph obtained by contracting tripods
-        for t in range(len(self.tripods)):
-            h3parents = self.h3parents(t)
-            assert(len(h3parents) <= 3)
-            assert(len(h3parents) == 0 or max(h3parents) < t)
+    """ Check that the partition is correct, raising AssertionError if not
+
+        This checks that the open legs partition the vertices and agree with
+        tripod_map, that the parents of each tripod are proper ancestors of
+        it in the tripod tree, and that every edge of G joins two legs of
+        the same tripod or two legs that are adjacent in h8 (and so two
+        tripods that are adjacent in h3).  It works on the flat arrays of
+        the packed partition (an unpacked one is converted first) using
+        iterator arithmetic, so it does no Python-level work per vertex or
+        edge.  With workers > 1, the edges are checked by a pool of worker
+        processes, in chunks of vertices.
+
+        With sample=eps, only a random sample of vertices (with their edges)
+        and tripods is checked instead, so this takes time independent of
+        n.  If at least a fraction eps of the vertices or of the tripods are
+        wrong, the check fails with probability at least confidence.
+    """
+    def verify_results(self, sample=None, confidence=0.999, workers=None,
+                       seed=None):
+        if self.succ is None:
+            raise ValueError("verify_results needs succ")
+        if sample is not None:
+            self._verify_sample(sample, confidence, seed)
+            return
+        _, tripods, tripod_map, tripod_tree = self._packed()
+        tripod, leg, index = tripod_map.columns
+        legs = tripods.legs
 
-        # Check the graph obtained by contracting legs
-        h8p = list()
-        for (t, i) in itertools.product(range(len(self.tripods)), range(3)):
-            h8parents = self.h8parents(t, i)
-            assert(len(h8parents) <= 8)
-            assert(len(h8parents) == 0 or max(h8parents) < (t,i))
-            h8p.append(h8parents)
+        # First make sure the tripods form a partition
+        _check_legs(legs.values, legs.offsets, tripod, leg, index)
+
+        # Check the graph obtained by contracting tripods: the h3-parents
+        # of t are the tripods containing its feet, and they must be proper
+        # ancestors of t in the tripod tree.  The h8-parents of each leg
+        # are built from these, so this also checks h8.
+        k = len(tripods)
+        # a pruned child (such as tripod 1 of a triangle) must read None
+        assert(max(tripod_tree.children, default=-1) < k)
+        ends = self.subtree_ends()
+        feet = map(legs.values.__getitem__,
+                   map(operator.sub, legs.offsets[4:], itertools.repeat(1)))
+        h3 = array.array('i', [-1]) * 3
+        h3.extend(map(tripod.__getitem__, feet))
+        owner = array.array('i', map(operator.floordiv, range(3, 3*k),
+                                     itertools.repeat(3)))
+        assert(all(map(operator.lt, h3[3:], owner)))
+        assert(all(map(operator.lt, owner, map(ends.__getitem__, h3[3:]))))
 
         # Check that h3 and h8 contain the graphs obtained by contracting
-        # tripods and legs, respectively
-        for u in range(len(self.succ)):
+        # tripods and legs, respectively, one range of vertices at a time
+        ends = array.array('i', ends)
+        ends.append(0)  # so that missing children (-1) have an empty subtree
+        n = len(tripod)
+        if workers is None or workers <= 1 or n < 4*VERIFY_CHUNK:
+            _check_edges(*_edge_arrays(self.succ, 0, n), tripod, leg, h3,
+                         tripod_tree.children, ends)
+            return
+        shm, size = _share_arrays([
+            ('map.tripod', tripod), ('map.leg', leg), ('h3', h3),
+            ('tree', tripod_tree.children), ('ends', ends)]
+            + _csr_sections(self.succ))
+        try:
+            chunk = max(VERIFY_CHUNK, -(-n // (4*workers)))
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(_verify_chunk, shm.name, size, lo,
+                                       min(lo+chunk, n))
+                           for lo in range(0, n, chunk)]
+                for future in futures:
+                    future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    """ Check a random sample of vertices and tripods
+
+        See verify_results.  Each sampled vertex v is checked against its
+        leg and each edge vw is checked as in the full verification, and
+        each sampled tripod is checked against tripod_map and its parents.
+    """
+    def _verify_sample(self, sample, confidence, seed):
+        if not 0 < sample < 1 or not 0 < confidence < 1:
+            raise ValueError("sample and confidence must be in (0, 1)")
+        rand = random.Random(seed)
+        count = math.ceil(math.log(1 - confidence) / math.log(1 - sample))
+        n, k = len(self.tripod_map), len(self.tripods)
+        for t in (rand.randrange(k) for _ in range(min(count, k))):
+            for i, path in enumerate(self.tripods[t]):
+                for j in range(len(path)-1):
+                    assert(tuple(self.tripod_map[path[j]]) == (t, i, j))
+            assert(max(self.h3parents(t), default=-1) < t)
+        for u in (rand.randrange(n) for _ in range(min(count, n))):
             (tu, iu, ju) = self.tripod_map[u]
+            assert(self.tripods[tu][iu][ju] == u)
             for v in self.succ[u]:
-                # if v < u: continue # no need to check every edge twice
                 (tv, iv, jv) = self.tripod_map[v]
                 if tu < tv:
                     assert(tu in self.h3parents(tv))
-                    assert((tu, iu) in h8p[3*tv+iv])
+                    assert((tu, iu) in self.h8parents(tv, iv))
                 elif tv < tu:
                     assert(tv in self.h3parents(tu))
-                    assert((tv, iv) in h8p[3*tu+iu])
-                elif iu < iv:
-                    assert((tu, iu) in h8p[3*tv+iv])
-                elif iv < iu:
-                    assert((tv, iv) in h8p[3*tu+iu])
+                    assert((tv, iv) in self.h8parents(tu, iu))
 
     """Return the path from v up in self.t until the first marked node """
     def tripod_path(self, v):
         path = list()
-        while not self.nma.is_marked(v):
+        parent = self.t.parent
+        marked = self.nma.marked
+        while not marked[v]:
             path.append(v)
-            v = self.t[v][0]  # v = parent(v)
+            v = parent[v]
         path.append(v)
         return path
 
@@ -501,6 +2265,31 @@ class tripod_partition(object):
                 else:
                     e[i] = v, e[i][1]
 
+    """Find the trichromatic triangle, starting with one portal
+
+    Walks from the portal e[0] for up to budget steps, as in
+    sperner_triangle.  If that fails, it continues from where it stopped
+    while also searching from the portals e[1] and e[2], as in
+    sperner_triangle_parallel.  The budget is a constant, so this costs at
+    most O(1) more per subproblem than sperner_triangle_parallel and keeps
+    the O(n log n) running time.
+    """
+    def sperner_triangle_auto(self, e, budget):
+        c0 = self.get_colour(e[0][0])
+        c1 = self.get_colour(e[0][1])
+        assert(c0 != c1)
+        e0 = e[0]
+        for _ in range(budget):
+            v = self.succ[e0[0]][e0[1]]
+            c = self.get_colour(v)
+            if c != c0 and c != c1:
+                return e0[0], e0[1], v
+            if c != c0:
+                e0 = e0[0], v
+            else:
+                e0 = v, e0[1]
+        return self.sperner_triangle_parallel([e0] + list(e[1:]))
+
     """Set the colour of v to c"""
     def set_colour(self, v, c):
         self.nma.mark(v)
@@ -513,6 +2302,905 @@ class tripod_partition(object):
 
 
 
+""" Solve a subproblem in a worker process for tripod_partition
+
+    job is the output of tripod_partition._subproblem_job.  This builds a
+    small tripod_partition on the vertices of the subproblem, in which the
+    vertices of the cycle are the marked roots of the BFS forest, and runs
+    the usual algorithm on it.  Returns (legs, tree), the tripods of the
+    subproblem (with legs given in terms of the original vertices) in
+    preorder and their rows of the tripod tree, in which the first tripod of
+    the subproblem is numbered 1.  If record is True, this also returns the
+    subproblem of each of these tripods (see tripod_partition.update).
+"""
+def _solve_subproblem(job, worst_case, prune, nma, auto_budget, record=False):
+    (paths, colours, faces, interior, parents) = job
+    cycle = paths[0] + paths[1] + paths[2]
+    vertices = cycle + interior
+    local = {v: i for (i, v) in enumerate(vertices)}
+    n = len(vertices)
+    succ = [dict() for _ in range(n)]
+    for f in range(0, len(faces), 3):
+        t = [local[faces[f+i]] for i in range(3)]
+        for i in range(3):
+            succ[t[i]][t[(i+1)%3]] = t[(i+2)%3]
+    t = [[-1] for _ in cycle] + [[local[p]] for p in parents]
+    for v in range(len(cycle), n):
+        t[t[v][0]].append(v)
+    t = bfs_tree.from_lists(t)
+
+    tp = tripod_partition.__new__(tripod_partition)
+    tp.auto_budget = auto_budget
+    tp.stats = None
+    tp.succ = succ
+    tp.t = t
+    tp.nma = MarkedAncestorStruct(t, range(len(cycle)), integer_sets[nma])
+    tp.tripod_map = [None] * n
+    tp.arena = array.array('i', range(len(cycle)))
+    tp.index_map = list(range(len(cycle))) + [None] * (n - len(cycle))
+    tp.index_map2 = [None] * n
+    tp.colours = [4] * n
+    tp.colours[:len(cycle)] = colours
+    lpaths = list()
+    start = 0
+    for path in paths:
+        lpaths.append(list_slice(tp.arena, start, start+len(path)))
+        start += len(path)
+    tp.tripods = [None]
+    tp.tripod_tree = [[None]*3]
+    tp._subproblems = [None] if record else None
+    tp._compute(lpaths, worst_case, prune)
+    legs = [[[vertices[v] for v in leg] for leg in tripod]
+            for tripod in tp.tripods[1:]]
+    if not record:
+        return legs, tp.tripod_tree[1:]
+    # the paths are all slices of the arena, so translate it only once
+    arena = array.array('i', [vertices[v] for v in tp.arena])
+    subproblems = [([list_slice(arena, path.start, path.stop)
+                     for path in paths], colours)
+                   for (paths, colours) in tp._subproblems[1:]]
+    return legs, tp.tripod_tree[1:], subproblems
+
+
+"""Files of named integer arrays
+
+A file written by save_arrays starts with the 8 byte magic string FILE_MAGIC, followed by the format version and the number of sections as little-endian uint32s.  Next comes a table with one 40 byte entry per section: a 16 byte null-padded name, a one byte array typecode (padded to 8 bytes) and the byte offset and number of elements of the section, as uint64s.  The data of each section is stored little-endian and aligned to 8 bytes, so it can be memory-mapped and cast to the right type without copying.
+"""
+FILE_MAGIC = b'LHPARRS\0'
+FILE_VERSION = 1
+
+def save_arrays(path, sections):
+    table, size = _array_table(sections)
+    # write to a temporary file first so readers never see a partial file
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp, 'wb') as fp:
+        for offset, data in _array_chunks(table, len(sections)):
+            fp.write(bytes(offset - fp.tell()))
+            fp.write(data)
+    os.replace(tmp, path)
+
+""" Return the layout of a file of arrays and its size in bytes """
+def _array_table(sections):
+    header = struct.calcsize('<8sII')
+    entry = struct.calcsize('<16ss7xQQ')
+    offset = header + entry*len(sections)
+    table = list()
+    for name, a in sections:
+        # a is an array.array or a memoryview of one (from load_arrays)
+        tc = a.typecode if isinstance(a, array.array) else a.format
+        offset = (offset + 7) & ~7
+        table.append((name, tc, a, offset))
+        offset += len(a) * array.array(tc).itemsize
+    return table, offset
+
+""" Generate the (offset, bytes) chunks of a file of arrays, in order """
+def _array_chunks(table, count):
+    yield 0, struct.pack('<8sII', FILE_MAGIC, FILE_VERSION, count)
+    pos = struct.calcsize('<8sII')
+    for name, tc, a, offset in table:
+        entry = struct.pack('<16ss7xQQ', name.encode(), tc.encode(),
+                            offset, len(a))
+        yield pos, entry
+        pos += len(entry)
+    for name, tc, a, offset in table:
+        if not isinstance(a, array.array) or sys.byteorder != 'little':
+            a = array.array(tc, a)
+            if sys.byteorder != 'little':
+                a.byteswap()
+        yield offset, a.tobytes()
+
+""" Load the arrays saved by save_arrays into a dictionary
+
+    If use_mmap is True (and the platform is little-endian) then the arrays
+    are memoryviews into a read-only memory map of the file.
+"""
+def load_arrays(path, use_mmap=True):
+    with open(path, 'rb') as fp:
+        if use_mmap:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = fp.read()
+    return _parse_arrays(data, path, use_mmap)
+
+""" Parse the arrays in data, which has the format written by save_arrays
+
+    If view is True (and the platform is little-endian) then the arrays are
+    memoryviews into data, otherwise they are copies.
+"""
+def _parse_arrays(data, path, view):
+    magic, version, count = struct.unpack_from('<8sII', data, 0)
+    if magic != FILE_MAGIC:
+        raise ValueError("{} is not an lhp array file".format(path))
+    if version != FILE_VERSION:
+        raise ValueError("{} has version {}, expected {}"
+                         .format(path, version, FILE_VERSION))
+    arrays = dict()
+    pos = struct.calcsize('<8sII')
+    entry = struct.calcsize('<16ss7xQQ')
+    buf = memoryview(data)
+    for i in range(count):
+        name, tc, offset, length = struct.unpack_from('<16ss7xQQ', data,
+                                                      pos + i*entry)
+        name, tc = name.rstrip(b'\0').decode(), tc.decode()
+        size = array.array(tc).itemsize
+        chunk = buf[offset:offset+length*size]
+        if view and sys.byteorder == 'little':
+            arrays[name] = chunk.cast(tc)
+        else:
+            a = array.array(tc, bytes(chunk))
+            if sys.byteorder != 'little':
+                a.byteswap()
+            arrays[name] = a
+    return arrays
+
+""" Return the tripod partition of a triangulation, using a file cache
+
+    The triangulation is given as a list of faces, as in
+    csr_triangulation.from_faces.  The cache key is a hash of the faces,
+    outer_face and the keyword arguments that affect the result, so a
+    partition is only recomputed if no partition of exactly the same input
+    has been saved in cache_dir.  Other keyword arguments are passed on to
+    the tripod_partition constructor.  Either way, the result is the packed
+    partition read by tripod_partition.load.
+"""
+def cached_partition(faces, outer_face, cache_dir, worst_case=True,
+                     prune=False, include_succ=False, **kwargs):
+    if len(faces) > 0 and not isinstance(faces[0], int):
+        faces = list(itertools.chain.from_iterable(faces))
+    h = hashlib.sha256()
+    h.update(array.array('q', faces).tobytes())
+    h.update(repr((list(outer_face), worst_case, prune,
+                   include_succ)).encode())
+    path = os.path.join(cache_dir, h.hexdigest() + '.lhp')
+    if os.path.exists(path):
+        return tripod_partition.load(path)
+    succ = csr_triangulation.from_faces(faces)
+    tp = tripod_partition(succ, outer_face, worst_case, prune=prune, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    tp.save(path, include_succ)
+    # load it back, so that a miss returns the same representation as a hit
+    return tripod_partition.load(path)
+
+""" Return the sections that store succ as a csr_triangulation """
+def _csr_sections(succ):
+    if not isinstance(succ, csr_triangulation):
+        succ = csr_triangulation.from_succ(succ)
+    return [('succ.offsets', succ.offsets), ('succ.heads', succ.heads),
+            ('succ.rotation', succ.rotation)]
+
+""" Copy (name, array) sections into a new block of shared memory
+
+    The block has the format written by save_arrays.  Returns the block and
+    the size of the data in it; the caller must close and unlink the block.
+"""
+def _share_arrays(sections):
+    table, size = _array_table(sections)
+    shm = multiprocessing.shared_memory.SharedMemory(create=True,
+                                                     size=max(size, 1))
+    for offset, data in _array_chunks(table, len(table)):
+        shm.buf[offset:offset+len(data)] = data
+    return shm, size
+
+""" Return copies of the arrays in a block written by _share_arrays """
+def _shared_arrays(name, size):
+    shm = multiprocessing.shared_memory.SharedMemory(name)
+    try:
+        with shm.buf[:size] as data:
+            return _parse_arrays(data, name, False)
+    finally:
+        shm.close()
+
+""" Return the outer face used when none is given
+
+    This is the face to the left of the first half-edge leaving vertex 0.
+"""
+def default_outer_face(succ):
+    u = 0
+    v = next(iter(succ[u]))
+    return [u, v, succ[u][v]]
+
+""" Choose an outer face that makes the BFS shallow
+
+    The depth of the BFS from the outer face bounds the length of every
+    leg, and with it the lengths of the Sperner walks, so a face near the
+    centre of G gives a faster computation and a partition with shorter
+    legs.  The methods are:
+    - 'default': default_outer_face(succ)
+    - 'centre': the better of the default face and a face at an
+      approximate centre c of G, found by a double sweep: a BFS from vertex
+      0 finds a far vertex a, BFSs from a and from the vertex b farthest
+      from a give distances da and db, and c minimizes max(da[c], db[c]).
+      This takes five BFSs, including the two that measure the faces.
+    - 'sample': the best of the 'centre' faces and samples faces chosen at
+      random, which takes samples+5 BFSs.  With workers > 1,
+      the candidate faces are evaluated by a pool of worker processes.
+    Faces are compared by the depth of the BFS from them and then by the
+    mean depth of a vertex.  Returns (outer_face, report), where report
+    lists (face, depth, mean_depth) for each candidate, best first.
+
+    If legs is True then each candidate is also partitioned (with
+    tripod_partition.stream, so that the tripods are not stored) and the
+    entries of the report become (face, depth, mean_depth, max_leg,
+    mean_leg), where max_leg is the maximum length of a leg without its
+    foot and mean_leg is the mean length of the legs that are not empty
+    (the mean over all legs is the same for every outer face).  The faces
+    are still ranked by depth, but this costs a full partition per
+    candidate.
+"""
+def choose_outer_face(succ, method='centre', samples=8, workers=None,
+                      seed=None, legs=False):
+    if method not in ('default', 'centre', 'sample'):
+        raise ValueError("unknown outer face method {}".format(method))
+    faces = [default_outer_face(succ)]
+    if method != 'default':
+        a = bfs_arrays(succ, [0]).order[-1]
+        da = bfs_arrays(succ, [a]).depth
+        b = da.index(max(da))
+        db = bfs_arrays(succ, [b]).depth
+        # minimize max(da[c], db[c]), breaking ties by da[c] + db[c]
+        key = array.array('q', map(operator.add, map(operator.mul,
+            map(max, da, db), itertools.repeat(2*len(succ))),
+            map(operator.add, da, db)))
+        c = key.index(min(key))
+        v = next(iter(succ[c]))
+        faces.insert(0, [c, v, succ[c][v]])
+    if method == 'sample':
+        rand = random.Random(seed)
+        for _ in range(samples):
+            u = rand.randrange(len(succ))
+            v = rand.choice(list(succ[u]))
+            faces.append([u, v, succ[u][v]])
+    faces = list({tuple(face): face for face in faces}.values())
+    if workers and workers > 1 and len(faces) > 1:
+        shm, size = _share_arrays(_csr_sections(succ))
+        try:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                depths = list(pool.map(_shared_face_depth,
+                                       itertools.repeat(shm.name),
+                                       itertools.repeat(size), faces,
+                                       itertools.repeat(legs)))
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        depths = [_face_depth(succ, face, legs) for face in faces]
+    report = sorted(((face,) + d for (face, d) in zip(faces, depths)),
+                    key=lambda x: x[1:])
+    return report[0][0], report
+
+""" Return the depth and mean depth of the BFS from face
+
+    If legs is True, also partition G with outer face face and return the
+    maximum leg length and the mean length of a non-empty leg as well.
+"""
+def _face_depth(succ, face, legs=False):
+    depth = bfs_arrays(succ, face[::-1]).depth
+    result = (max(depth), sum(depth) / len(depth))
+    if legs:
+        lengths = array.array('q', itertools.chain.from_iterable(
+            map(len, closed) for (_, _, _, closed) in tripod_partition.stream(
+                succ, face, validate=False)))
+        # the lengths include the feet
+        nonempty = array.array('q', filter(None, map(operator.sub, lengths,
+                                                     itertools.repeat(1))))
+        result += (max(lengths) - 1,
+                   sum(nonempty) / len(nonempty) if nonempty else 0.0)
+    return result
+
+""" Run _face_depth in a worker, on succ as written by _share_arrays """
+def _shared_face_depth(name, size, face, legs=False):
+    a = _shared_arrays(name, size)
+    return _face_depth(csr_triangulation(a['succ.offsets'], a['succ.heads'],
+                                         a['succ.rotation']), face, legs)
+
+""" Triangulate a plane graph without creating multiple edges
+
+    rotations[u] lists the neighbours of u in counterclockwise order, for a
+    connected plane graph with vertex set 0,...,n-1 and n >= 3.  Each face
+    of length 3 is kept.  Each longer face, with boundary walk x[0],...,x[k-1],
+    gets a new vertex joined to every x[i].  If some vertex appears more than
+    once in the walk, which happens at cut vertices, this would create
+    multiple edges, so instead the face gets a ring r[0],...,r[k-1] of new
+    vertices, with r[i] joined to x[i] and x[i+1], and a new vertex joined
+    to the ring.  The new vertices are numbered n, n+1, ... and this takes
+    O(n) time.
+
+    Returns (succ, outer_face), where succ is the triangulation as a list of
+    dictionaries and outer_face is the face to the left of the half-edge
+    outer_edge (by default, the first half-edge leaving vertex 0).  The
+    input is not checked beyond what is needed to walk its faces, but
+    tripod_partition checks the triangulation with validate_embedding,
+    which fails if and only if the input was not a plane graph.
+"""
+def triangulate_plane_graph(rotations, outer_edge=None):
+    n = len(rotations)
+    if n < 3:
+        raise EmbeddingError("a plane graph needs at least 3 vertices")
+    # the face to the left of uv continues with vw, where w comes just
+    # before u in the counterclockwise order around v
+    before = [dict(zip(r, r[-1:] + r[:-1])) for r in rotations]
+    succ = [dict() for _ in range(n)]
+    def triangle(a, b, c):
+        succ[a][b], succ[b][c], succ[c][a] = c, a, b
+    seen = [set() for _ in range(n)]
+    for u0 in range(n):
+        for v0 in rotations[u0]:
+            if v0 in seen[u0]:
+                continue
+            walk = list()
+            u, v = u0, v0
+            while v not in seen[u]:
+                seen[u].add(v)
+                walk.append(u)
+                try:
+                    u, v = v, before[v][u]
+                except (KeyError, IndexError):
+                    raise EmbeddingError("{} is a neighbour of {} but not "
+                                         "vice versa".format(v, u),
+                                         vertices=[u, v]) from None
+            if (u, v) != (u0, v0):
+                raise EmbeddingError("the face walk from {} does not return"
+                                     .format((u0, v0)), vertices=walk)
+            k = len(walk)
+            if k < 3:
+                raise EmbeddingError("a face of length {} implies a multiple "
+                                     "edge".format(k), vertices=walk)
+            if k == 3:
+                triangle(*walk)
+            elif len(set(walk)) == k:
+                h = len(succ)
+                succ.append(dict())
+                for i in range(k):
+                    triangle(walk[i], walk[(i+1)%k], h)
+            else:
+                r = len(succ)
+                h = r + k
+                succ.extend(dict() for _ in range(k+1))
+                for i in range(k):
+                    j = (i+1) % k
+                    triangle(walk[i], walk[j], r+i)
+                    triangle(r+i, walk[j], r+j)
+                    triangle(r+i, r+j, h)
+    if outer_edge is None:
+        outer_edge = (0, rotations[0][0])
+    u, v = outer_edge
+    return succ, [u, v, succ[u][v]]
+
+""" Compute the tripod partition of a plane graph that need not be a
+    triangulation
+
+    The plane graph is given by rotations, as in triangulate_plane_graph,
+    and other keyword arguments are passed on to the tripod_partition
+    constructor.  The result is the partition of the triangulation, in
+    which vertices 0,...,n-1 are the vertices of the input, so tripod_map[v]
+    and layers[v] are correct for them.  The layers are BFS layers of the
+    triangulation, and every edge of the input joins two vertices in the
+    same or consecutive layers.  Every edge of the input is also an edge of
+    the triangulation, so h3parents and h8parents describe supergraphs of
+    the graphs obtained by contracting the parts of the input.  Use
+    restrict(n) to remove the added vertices from the tripods.
+"""
+def partition_plane_graph(rotations, outer_edge=None, **kwargs):
+    succ, outer_face = triangulate_plane_graph(rotations, outer_edge)
+    return tripod_partition(succ, outer_face, **kwargs)
+
+""" Compute the tripod partitions of many triangulations in a worker pool
+
+    inputs is a sequence of triangulations, each given as a flat sequence of
+    the 3f vertices of its faces, as returned by read_faces.  outer_faces
+    is an optional list of outer faces; by default each uses
+    default_outer_face.  The faces are copied into one block of shared
+    memory, workers partition consecutive chunks of inputs, and each chunk's
+    results come back as one shared-memory block of arrays in the format of
+    save_arrays, so no large Python objects are pickled.
+
+    Returns (partitions, seconds), where partitions[i] is a packed
+    tripod_partition of inputs[i] and seconds[i] is the time it took to
+    compute, as seen by the worker.  The partitions keep their succ, as a
+    csr_triangulation, only if include_succ is True.  Other keyword
+    arguments are passed on to the tripod_partition constructor, except
+    packed, since the results are always packed.  With workers=1,
+    everything is done in this process, with the same results.
+"""
+def partition_many(inputs, outer_faces=None, workers=None, include_succ=False,
+                   **kwargs):
+    if 'packed' in kwargs:
+        raise TypeError("partition_many() always returns packed partitions, "
+                        "so it does not take a packed argument")
+    if outer_faces is None:
+        outer_faces = [None] * len(inputs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(inputs) <= 1:
+        results = [_partition_item(faces, outer_face, kwargs)
+                   for (faces, outer_face) in zip(inputs, outer_faces)]
+        if not include_succ:
+            # as if it had come back from a worker without its succ section
+            for (tp, _) in results:
+                tp.succ = None
+        return ([tp for (tp, _) in results],
+                array.array('d', [seconds for (_, seconds) in results]))
+
+    bounds = [0]
+    for faces in inputs:
+        bounds.append(bounds[-1] + len(faces))
+    size = array.array('i').itemsize
+    shm = multiprocessing.shared_memory.SharedMemory(
+        create=True, size=max(size*bounds[-1], 1))
+    try:
+        view = shm.buf.cast('i')
+        for i, faces in enumerate(inputs):
+            view[bounds[i]:bounds[i+1]] = array.array('i', faces)
+        view.release()
+        chunk = max(1, len(inputs) // (4*workers))
+        partitions = [None] * len(inputs)
+        seconds = array.array('d', [0]) * len(inputs)
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_partition_chunk, shm.name, bounds[i:i+chunk+1],
+                                   outer_faces[i:i+chunk], include_succ, kwargs)
+                       for i in range(0, len(inputs), chunk)]
+            for i, future in zip(range(0, len(inputs), chunk), futures):
+                name, items = future.result()
+                out = multiprocessing.shared_memory.SharedMemory(name)
+                try:
+                    for j, (offset, length, t) in enumerate(items):
+                        with out.buf[offset:offset+length] as data:
+                            a = _parse_arrays(data, name, False)
+                        partitions[i+j] = tripod_partition._from_arrays(a)
+                        seconds[i+j] = t
+                finally:
+                    out.close()
+                    out.unlink()
+    finally:
+        shm.close()
+        shm.unlink()
+    return partitions, seconds
+
+def _partition_item(faces, outer_face, kwargs):
+    start = time.perf_counter()
+    succ = csr_triangulation.from_faces(faces)
+    if outer_face is None:
+        outer_face = default_outer_face(succ)
+    tp = tripod_partition(succ, outer_face, packed=True, **kwargs)
+    return tp, time.perf_counter() - start
+
+""" Partition the inputs bounds[i]:bounds[i+1] of the shared memory name
+
+    Runs in a worker of partition_many.  Returns the name of a new shared
+    memory block holding the results, one after the other, and a list of
+    (offset, size, seconds) for the items.
+"""
+def _partition_chunk(name, bounds, outer_faces, include_succ, kwargs):
+    shm = multiprocessing.shared_memory.SharedMemory(name)
+    try:
+        view = shm.buf.cast('i')
+        results = list()
+        for i, outer_face in enumerate(outer_faces):
+            faces = array.array('i', view[bounds[i]:bounds[i+1]])
+            tp, seconds = _partition_item(faces, outer_face, kwargs)
+            results.append((_array_table(tp._sections(include_succ)),
+                            seconds))
+        view.release()
+    finally:
+        shm.close()
+    offsets = [0]
+    for ((_, size), _) in results:
+        offsets.append((offsets[-1] + size + 7) & ~7)
+    out = multiprocessing.shared_memory.SharedMemory(
+        create=True, size=max(offsets[-1], 1))
+    for i, ((table, _), _) in enumerate(results):
+        for offset, data in _array_chunks(table, len(table)):
+            pos = offsets[i] + offset
+            out.buf[pos:pos+len(data)] = data
+    items = [(offsets[i], size, seconds)
+             for i, ((_, size), seconds) in enumerate(results)]
+    out.close()
+    return out.name, items
+
+
+# vertices per chunk when verify_results uses worker processes
+VERIFY_CHUNK = 1 << 16
+
+""" Check that the open legs of the tripods partition the vertices
+
+    The legs are rows of values[offsets[r]:offsets[r+1]] and leg r = 3t+i
+    is leg i of tripod t.  Every vertex v must appear in exactly one open
+    leg, at tripods[tripod[v]][leg[v]][index[v]].
+"""
+def _check_legs(values, offsets, tripod, leg, index):
+    rows = len(offsets) - 1
+    lens = array.array('q', map(operator.sub, offsets[1:], offsets[:-1]))
+    assert(min(lens, default=1) >= 1)  # every leg has a foot
+    pos = array.array('q', itertools.chain.from_iterable(map(range, lens)))
+    last = itertools.chain.from_iterable(map(itertools.repeat,
+        map(operator.sub, lens, itertools.repeat(1)), lens))
+    is_open = bytearray(map(operator.ne, pos, last))
+    vertices = array.array('i', itertools.compress(values, is_open))
+    assert(len(vertices) == len(tripod))
+    assert(min(vertices, default=0) >= 0)
+    row = array.array('q', itertools.compress(itertools.chain.from_iterable(
+        map(itertools.repeat, range(rows), lens)), is_open))
+    assert(array.array('q', map(tripod.__getitem__, vertices))
+           == array.array('q', map(operator.floordiv, row,
+                                   itertools.repeat(3))))
+    assert(array.array('q', map(leg.__getitem__, vertices))
+           == array.array('q', map(operator.mod, row, itertools.repeat(3))))
+    assert(array.array('q', map(index.__getitem__, vertices))
+           == array.array('q', itertools.compress(pos, is_open)))
+
+""" Return arrays (src, dst) of the edges leaving vertices lo,...,hi-1 """
+def _edge_arrays(succ, lo, hi):
+    if isinstance(succ, csr_triangulation):
+        degrees = map(operator.sub, succ.offsets[lo+1:hi+1],
+                      succ.offsets[lo:hi])
+        dst = array.array('i', succ.heads[succ.offsets[lo]:succ.offsets[hi]])
+    else:
+        degrees = map(len, succ[lo:hi])
+        dst = array.array('i', itertools.chain.from_iterable(succ[lo:hi]))
+    src = array.array('i', itertools.chain.from_iterable(
+        map(itertools.repeat, range(lo, hi), degrees)))
+    return src, dst
+
+""" Check that each edge uv is represented in h3 and h8
+
+    If u is in leg iu of tripod tu, v is in leg iv of tripod tv and tu < tv
+    then tu must be one of the parents h3[3tv:3tv+3] of tv, and tv must not
+    be in subtree iu of tu (with the root's subtrees being those of tripod
+    1), since those are the subtrees that leg (tu, iu) is separated from.
+    ends is subtree_ends() followed by a 0.  Edges with tu >= tv are checked
+    from the other side.
+"""
+def _check_edges(src, dst, tripod, leg, h3, children, ends):
+    tu = map(tripod.__getitem__, src)
+    tv = map(tripod.__getitem__, dst)
+    keep = bytearray(map(operator.lt, tu, tv))
+    src = array.array('i', itertools.compress(src, keep))
+    dst = array.array('i', itertools.compress(dst, keep))
+    tu = array.array('i', map(tripod.__getitem__, src))
+    tv = array.array('i', map(tripod.__getitem__, dst))
+    iu = map(leg.__getitem__, src)
+    x = array.array('q', map(operator.mul, tv, itertools.repeat(3)))
+    in_h3 = map(operator.or_, map(operator.or_,
+        map(operator.eq, tu, map(h3.__getitem__, x)),
+        map(operator.eq, tu, map(h3.__getitem__,
+                                 map(operator.add, x, itertools.repeat(1))))),
+        map(operator.eq, tu, map(h3.__getitem__,
+                                 map(operator.add, x, itertools.repeat(2)))))
+    c = array.array('i', map(children.__getitem__, map(operator.add,
+        map(operator.mul, map(max, tu, itertools.repeat(1)),
+            itertools.repeat(3)), iu)))
+    in_h8 = map(operator.or_, map(operator.lt, tv, c),
+                map(operator.ge, tv, map(ends.__getitem__, c)))
+    ok = bytearray(map(operator.and_, in_h3, in_h8))
+    e = ok.find(0)
+    if e >= 0:
+        u, v = src[e], dst[e]
+        raise AssertionError("edge ({}, {}) is not represented: {} is in leg"
+                             " {} and {} is in leg {}".format(
+                                 u, v, u, (tu[e], leg[u]), v, (tv[e], leg[v])))
+
+""" Check the edges of vertices lo,...,hi-1 in a worker of verify_results
+
+    name is a shared memory block of size bytes written by _share_arrays.
+"""
+def _verify_chunk(name, size, lo, hi):
+    a = _shared_arrays(name, size)
+    succ = csr_triangulation(a['succ.offsets'], a['succ.heads'],
+                             a['succ.rotation'])
+    _check_edges(*_edge_arrays(succ, lo, hi), a['map.tripod'], a['map.leg'],
+                 a['h3'], a['tree'], a['ends'])
+
+
+""" Return a centroid decomposition of a tree decomposition
+
+    The tree decomposition is given as (parent, offsets, bags), as returned
+    by tripod_partition.h3decomposition(), in which the first element of the
+    bag of x is x itself.  The nodes are weighted by weights[x], which is
+    modified.  The root of the result is a centroid c of the tree: each
+    component of the tree minus c has at most half the total weight.  The
+    children of the root are the decompositions of these components, except
+    those of weight 0.  The elements of node c are the elements of its bag
+    that are not elements of one of its ancestors and have non-zero weight.
+
+    Returns (parent, offsets, elements) where parent[x] is the parent of
+    node x (-1 for the root) and the elements of node x are
+    elements[offsets[x]:offsets[x+1]].  Nodes are numbered in preorder.
+    This runs in O(k log k) time for a tree with k nodes.
+"""
+def _centroid_decomposition(tree_parent, offsets, bags, weights):
+    k = len(tree_parent)
+    first = array.array('q', [0]) * (k+1)
+    for x in tree_parent:
+        if x >= 0:
+            first[x+1] += 1
+    for x in range(k):
+        first[x+1] += first[x]
+    children = array.array('i', [0]) * first[k]
+    fill = array.array('q', first)
+    for y in range(k):
+        x = tree_parent[y]
+        if x >= 0:
+            children[fill[x]] = y
+            fill[x] += 1
+    def neighbours(u):
+        yield from children[first[u]:first[u+1]]
+        if tree_parent[u] >= 0:
+            yield tree_parent[u]
+
+    removed = bytearray(k)
+    pred = array.array('i', [-1]) * k
+    sub = array.array('q', [0]) * k
+    parent = array.array('i')
+    node_offsets = array.array('q', [0])
+    elements = array.array('i')
+    # stack holds (tree node, parent node) for the components that are left
+    stack = [(0, -1)] if k > 0 else []
+    while stack:
+        root, up = stack.pop()
+        # the nodes of the component containing root, in BFS order
+        pred[root] = -1
+        piece = [root]
+        for u in piece:
+            for x in neighbours(u):
+                if x != pred[u] and not removed[x]:
+                    pred[x] = u
+                    piece.append(x)
+        for u in piece:
+            sub[u] = weights[u]
+        for u in reversed(piece[1:]):
+            sub[pred[u]] += sub[u]
+        total = sub[root]
+        if total == 0:
+            continue
+        c = root
+        while True:
+            heavy = [x for x in neighbours(c) if x != pred[c]
+                     and not removed[x] and 2*sub[x] > total]
+            if not heavy:
+                break
+            c = heavy[0]
+
+        removed[c] = True
+        node = len(parent)
+        parent.append(up)
+        for e in bags[offsets[c]:offsets[c+1]]:
+            if weights[e] > 0:
+                elements.append(e)
+                weights[e] = 0
+        node_offsets.append(len(elements))
+        for x in neighbours(c):
+            if not removed[x]:
+                stack.append((x, node))
+    return parent, node_offsets, elements
+
+""" Return ranks from a hierarchy returned by _centroid_decomposition
+
+    The elements of each node get distinct ranks, and the ranks at each
+    depth of the hierarchy are larger than those at greater depths.  If the
+    elements of every edge of a graph are in the same node or in an ancestor
+    and a descendant, then this is a vertex ranking of the graph.  Returns
+    an array of size ranks, with -1 for the elements that are not in the
+    hierarchy.
+"""
+def _hierarchy_ranks(parent, offsets, elements, size):
+    depth = array.array('i', [0]) * len(parent)
+    width = [0]
+    for x in range(len(parent)):
+        if parent[x] >= 0:
+            depth[x] = depth[parent[x]] + 1
+        if depth[x] == len(width):
+            width.append(0)
+        width[depth[x]] = max(width[depth[x]], offsets[x+1] - offsets[x])
+    base = [0] * len(width)
+    for d in range(len(width)-2, -1, -1):
+        base[d] = base[d+1] + width[d+1]
+    ranks = array.array('i', [-1]) * size
+    for x in range(len(parent)):
+        for i in range(offsets[x], offsets[x+1]):
+            ranks[elements[i]] = base[depth[x]] + i - offsets[x]
+    return ranks
+
+""" Return True if colours is a p-centred colouring of the graph succ
+
+    Checks every connected subgraph with at most p colours by enumerating
+    the sets C of at most p colours that appear on connected subgraphs.  For
+    each component K of the subgraph induced by the colours in C, some
+    vertex u of K must have a colour that is unique in K, and then every
+    component of K - u must pass the same test.  This is only practical for
+    small p.
+"""
+def check_centred_colouring(succ, colours, p):
+    n = len(succ)
+    seen = set()
+    todo = [frozenset([c]) for c in set(colours)]
+    while todo:
+        cs = todo.pop()
+        if cs in seen:
+            continue
+        seen.add(cs)
+        done = bytearray(n)
+        for s in range(n):
+            if done[s] or colours[s] not in cs:
+                continue
+            component = [s]
+            done[s] = True
+            for v in component:
+                for w in succ[v]:
+                    if not done[w] and colours[w] in cs:
+                        done[w] = True
+                        component.append(w)
+                    elif len(cs) < p and colours[w] not in cs:
+                        todo.append(cs | {colours[w]})
+            if not _has_centres(succ, colours, component):
+                return False
+    return True
+
+def _has_centres(succ, colours, vertices):
+    stack = [vertices]
+    while stack:
+        component = stack.pop()
+        counts = collections.Counter(colours[v] for v in component)
+        centres = [v for v in component if counts[colours[v]] == 1]
+        if not centres:
+            return False
+        # the components of component - centres[0]
+        left = set(component)
+        left.discard(centres[0])
+        while left:
+            s = left.pop()
+            part = [s]
+            for v in part:
+                for w in succ[v]:
+                    if w in left:
+                        left.discard(w)
+                        part.append(w)
+            stack.append(part)
+    return True
+
+""" Return True if ranks is a vertex ranking of the graph succ
+
+    This adds the vertices in order of rank to a union-find structure and
+    checks that no component of the subgraph induced by the vertices of
+    rank at most r contains two vertices of rank r.  It runs in
+    O((n + m) log n) time.
+"""
+def check_vertex_ranking(succ, ranks):
+    n = len(succ)
+    uf = array.array('i', range(n))
+    def find(x):
+        while uf[x] != x:
+            uf[x] = uf[uf[x]]
+            x = uf[x]
+        return x
+    order = sorted(range(n), key=ranks.__getitem__)
+    i = 0
+    while i < n:
+        j = i
+        while j < n and ranks[order[j]] == ranks[order[i]]:
+            j += 1
+        for v in order[i:j]:
+            for w in succ[v]:
+                if ranks[w] <= ranks[v]:
+                    uf[find(w)] = find(v)
+        roots = [find(v) for v in order[i:j]]
+        if len(set(roots)) < len(roots):
+            return False
+        i = j
+    return True
+
+
+"""Adjacency labels
+
+Each vertex v gets a label of LABEL_WORDS int32s: [x, l, mask, p0, ..., p7] where x = 3*t+i is the leg of h8 that contains v, l is the layer of v, p0,...,p7 are the parents of x in h8decomposition() (padded with -1) and bit 3*j+d+1 of mask is set if v is adjacent to the vertex of leg pj in layer l+d, for d in {-1,0,1}.  Each leg is a vertical path in the BFS tree, so it has at most one vertex in each layer and (x, l) identifies v.  Whether u and v are adjacent can be decided from their labels alone: if they are in the same leg then they are adjacent if and only if their layers differ by 1.  Otherwise, the edge uv joins two legs that are adjacent in h8, so the leg of one of them, say v, is among the parents of the leg of the other, u, and the edge is recorded in the mask of u.
+"""
+LABEL_WORDS = 11
+
+def _labels_adjacent(a, i, b, j):
+    if a[i] < b[j]:
+        a, i, b, j = b, j, a, i
+    d = b[j+1] - a[i+1]
+    if a[i] == b[j]:
+        return d == 1 or d == -1
+    if d < -1 or d > 1:
+        return False
+    for k in range(8):
+        if a[i+3+k] == b[j]:
+            return (a[i+2] >> (3*k+d+1)) & 1 == 1
+    return False
+
+""" Return True if the vertices with labels a and b are adjacent """
+def labels_adjacent(a, b):
+    return _labels_adjacent(a, 0, b, 0)
+
+""" Apply labels_adjacent to many pairs of labels
+
+    a and b are flat sequences of labels, as stored in
+    adjacency_labelling.labels.  Returns a bytearray whose i-th entry is 1
+    if the i-th label of a and the i-th label of b are adjacent.  This is
+    a convenience wrapper around the scalar test: most queries return
+    after a few comparisons, which a loop over columns cannot exploit.
+"""
+def labels_adjacent_many(a, b):
+    m = len(a) // LABEL_WORDS
+    result = bytearray(m)
+    for i in range(0, m*LABEL_WORDS, LABEL_WORDS):
+        if _labels_adjacent(a, i, b, i):
+            result[i // LABEL_WORDS] = 1
+    return result
+
+"""The adjacency labels of all vertices of a graph
+
+The labels are stored in one flat int32 sequence, and the label of vertex v is labels[LABEL_WORDS*v:LABEL_WORDS*(v+1)].  to_bytes() and from_bytes() convert this to and from n followed by the labels as little-endian int32s, so the labels can be used without the graph or the partition.
+"""
+class adjacency_labelling(object):
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels) // LABEL_WORDS
+
+    def __getitem__(self, v):
+        return list_slice(self.labels, LABEL_WORDS*v, LABEL_WORDS*(v+1))
+
+    def adjacent(self, u, v):
+        return _labels_adjacent(self.labels, LABEL_WORDS*u,
+                                self.labels, LABEL_WORDS*v)
+
+    """ Return a bytearray whose i-th entry is 1 if us[i] and vs[i] are adjacent
+
+        Like labels_adjacent_many, this applies the scalar test to each
+        pair.
+    """
+    def adjacent_many(self, us, vs):
+        labels = self.labels
+        result = bytearray(len(us))
+        for i in range(len(us)):
+            if _labels_adjacent(labels, LABEL_WORDS*us[i],
+                                labels, LABEL_WORDS*vs[i]):
+                result[i] = 1
+        return result
+
+    def to_bytes(self):
+        a = array.array('i', [len(self)])
+        a.extend(self.labels)
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a.tobytes()
+
+    """ Read labels written by to_bytes(), without copying if possible """
+    @classmethod
+    def from_bytes(cls, data):
+        view = memoryview(data)
+        size = array.array('i').itemsize
+        n = struct.unpack_from('<i', view, 0)[0]
+        chunk = view[size:size*(1+LABEL_WORDS*n)]
+        if sys.byteorder == 'little':
+            return cls(chunk.cast('i'))
+        a = array.array('i', bytes(chunk))
+        a.byteswap()
+        return cls(a)
+
+
 """Standalone program code
 
 This can also be used as a standalone program that reads a triangulation from stdin and outputs a list of tripods to stdout.
@@ -527,32 +3215,317 @@ The output represents the closed tripods in a tripod partition.
 - Lines 3i-2, 3i-1, 3i are the legs of tripod i (for each i in {1,...,k})
 Each leg of the tripod begins with a vertex of the Sperner triangle and ends
 at a vertex in one of the three parent tripods.
+
+With -ib, the input is instead the 3f vertices of the faces as raw
+little-endian int32s, with no header.  With -ob, each part of the output
+is written as little-endian int32s: a count, then (except for the map) the
+count+1 offsets of a CSR list, then its values.  See write_results_binary.
+
+With -m, the input is any number of triangulations, one after the other,
+each in the format above (with -ib, each is preceded by its number of
+faces f as an int32).  They are partitioned by partition_many and the
+results for each one are written in turn, in the same format as for a
+single triangulation.  The time taken for each triangulation is written to
+stderr as a line "i n seconds".
 """
-if __name__ == "__main__":
-    f = int(sys.stdin.readline())
-    n = (f+5) // 2
-    succ = [dict() for _ in range(n)]
-    for _ in range(f):
-        line = sys.stdin.readline()
-        t = [int(x) for x in line.split()]
-        for i in range(3):
-            succ[t[i]][t[(i+1)%3]] = t[(i+2)%3]
 
-    # This hack makes it possible to use a command line like
-    # rbox y <n-3> D2 | qhull d Qt i | python3 lhp.py
+""" Read a list of faces in the text format described above
+
+    The whole input is read and tokenised at once.  Returns the faces as a
+    flat int32 array of length 3f.
+"""
+def read_faces(stream):
+    tokens = stream.read().split()
+    f = int(tokens[0])
+    if len(tokens) < 3*f + 1:
+        raise ValueError("expected {} faces but found only {}"
+                         .format(f, (len(tokens)-1)//3))
+    return array.array('i', map(int, itertools.islice(tokens, 1, 3*f+1)))
+
+""" Read any number of lists of faces in the text format
+
+    Returns a list of flat int32 arrays, one per triangulation.
+"""
+def read_face_lists(stream):
+    tokens = stream.read().split()
+    lists = list()
+    pos = 0
+    while pos < len(tokens):
+        f = int(tokens[pos])
+        if len(tokens) < pos + 3*f + 1:
+            raise ValueError("expected {} faces but found only {}"
+                             .format(f, (len(tokens)-pos-1)//3))
+        lists.append(array.array('i', map(int, tokens[pos+1:pos+3*f+1])))
+        pos += 3*f + 1
+    return lists
+
+""" Read any number of lists of faces stored as little-endian int32s
+
+    Each list is its number f of faces followed by its 3f vertices.
+"""
+def read_face_lists_binary(stream):
+    faces = read_faces_binary(stream, check=False)
+    lists = list()
+    pos = 0
+    while pos < len(faces):
+        f = faces[pos]
+        if len(faces) < pos + 3*f + 1:
+            raise ValueError("expected {} faces but found only {}"
+                             .format(f, (len(faces)-pos-1)//3))
+        lists.append(faces[pos+1:pos+3*f+1])
+        pos += 3*f + 1
+    return lists
+
+""" Read a list of faces stored as raw little-endian int32s
+
+    If stream is a regular file then it is memory-mapped rather than read.
+    Returns a sequence of length 3f that can be indexed like an array.
+"""
+def read_faces_binary(stream, check=True):
+    try:
+        data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        data = stream.read()
+    if check and len(data) % 12 != 0:
+        raise ValueError("binary input size is not a multiple of 12 bytes")
+    if sys.byteorder == 'little':
+        return memoryview(data).cast('i')
+    faces = array.array('i', bytes(data))
+    faces.byteswap()
+    return faces
+
+""" Add the outer face [0,1,2] or [2,1,0] if exactly one face is missing
+
+    This hack makes it possible to use a command line like
+    rbox y <n-3> D2 | qhull d Qt i | python3 lhp.py
+    Returns the (possibly extended) faces and the number of vertices.
+"""
+def add_missing_face(faces):
+    f = len(faces) // 3
+    n = (f+5) // 2
     if f == 2*n-5:
-        f += 1
         sys.stderr.write("Warning: One face too few, assuming outerface [0,1,2]\n")
         t = [0, 1, 2]
-        if 1 in succ[0]:
-            t = t[::-1]
-        for i in range(3):
-            succ[t[i]][t[(i+1)%3]] = t[(i+2)%3]
+        for i in range(0, len(faces), 3):
+            for j in range(3):
+                if faces[i+j] == 0 and faces[i+(j+1)%3] == 1:
+                    t = t[::-1]
+        faces = array.array('i', faces)
+        faces.extend(t)
+    return faces, n
+
+""" The parts of the output, in the order they are written """
+output_parts = ['tripods', 'map', 'h3', 'h8']
+
+""" Return the CSR (offsets, values) form of an output part
+
+    For 'tripods' there is one row per leg (3k rows), for 'h3' there is one
+    row per tripod listing its h3 parents and for 'h8' there is one row per
+    leg (t,i), listing the legs 3p+j in h8parents(t,i).  'map' has no CSR
+    form; it is written as three columns.
+"""
+def _output_rows(tp, part):
+    if part == 'tripods':
+        # a packed copy, so that writing the output leaves tp as it is
+        legs = tp._packed()[1].legs
+        return legs.offsets, legs.values
+    if part == 'h3':
+        _, offsets, bags = tp.h3decomposition()
+    else:
+        _, offsets, bags = tp.h8decomposition()
+    # drop the first element of each bag, which is the node itself
+    values = array.array('i')
+    for i in range(len(offsets)-1):
+        values.extend(bags[offsets[i]+1:offsets[i+1]])
+    return array.array('q', [offsets[i] - i for i in range(len(offsets))]), values
+
+""" Write the selected parts of the results in the text format
+
+    Each part starts with a line containing the number of lines that follow.
+    For 'tripods' this is the number k of tripods (followed by 3k lines),
+    for 'map' it is n (followed by lines "t i j", where (t,i,j) is
+    tripod_map[v]), for 'h3' it is k and for 'h8' it is 3k.
+"""
+def write_results(tp, parts, out):
+    for part in output_parts:
+        if part not in parts:
+            continue
+        if part == 'map':
+            out.write("{}\n".format(len(tp.tripod_map)))
+            out.write("".join("{} {} {}\n".format(*x) for x in tp.tripod_map))
+            continue
+        if part == 'tripods':
+            out.write("{}\n".format(len(tp.tripods)))
+            out.write("".join(" ".join(map(str, leg)) + "\n"
+                              for t in tp.tripods for leg in t))
+            continue
+        offsets, values = _output_rows(tp, part)
+        rows = len(offsets) - 1
+        out.write("{}\n".format(rows))
+        chunk = 1 << 16
+        for i in range(0, rows, chunk):
+            out.write("".join(" ".join(map(str, values[offsets[j]:offsets[j+1]])) + "\n"
+                              for j in range(i, min(rows, i+chunk))))
+
+""" Write the selected parts of the results as little-endian int32s
+
+    'map' is written as n followed by the three columns of tripod_map.  The
+    other parts are written as a count (k for 'tripods' and 'h3', 3k for
+    'h8'), then the offsets of a CSR list, then its values.  For 'tripods',
+    the CSR list has one row per leg, so it has 3k+1 offsets.
+"""
+def write_results_binary(tp, parts, out):
+    def write(a):
+        a = array.array('i', a)
+        if sys.byteorder != 'little':
+            a.byteswap()
+        out.write(a.tobytes())
+
+    for part in output_parts:
+        if part not in parts:
+            continue
+        if part == 'map':
+            tripod_map = tp._packed()[2]
+            write([len(tripod_map)])
+            for column in tripod_map.columns:
+                write(column)
+            continue
+        offsets, values = _output_rows(tp, part)
+        rows = len(offsets) - 1
+        write([rows // 3 if part == 'tripods' else rows])
+        write(offsets)
+        write(values)
+
+def usage():
+    print("Computes a tripod decomposition of a triangulation read from stdin")
+    print("Usage: {} [-h] [-w] [-b] [-a] [-ib] [-ob] [-s] [-m] [-j <w>] [--stats] [--no-validate] [--outer <method>] [-e <parts>]".format(sys.argv[0]))
+    print("  -h show this message")
+    print("  -w use O(n log n) time algorithm (default)")
+    print("  -b use O(n^2) time algorithm (usually faster)")
+    print("  -a use a single walk with an O(n log n) fallback")
+    print("  -ib read faces as raw little-endian int32s")
+    print("  -ob write results as little-endian int32s")
+    print("  -s write tripods as soon as they are computed (text tripods only)")
+    print("  -m read and partition any number of triangulations")
+    print("  -j <w> use w worker processes")
+    print("  --stats write statistics about the run to stderr (not with -m)")
+    print("  --no-validate don't check that the input is a triangulation")
+    print("  --outer <method> choose the outer face by default, centre or sample")
+    print("     and report the BFS depth of the candidates (not with -m)")
+    print("  -e <parts> comma-separated parts to output, from")
+    print("     {} (default = tripods)".format(",".join(output_parts)))
 
-    outer_face = [0, next(iter(succ[0])), None]
-    outer_face[2] = succ[outer_face[0]][outer_face[1]]
-    tp = tripod_partition(succ, outer_face, True)
-    print(len(tp.tripods))
-    for t in tp.tripods:
-        for leg in t:
-            print(" ".join([str(v) for v in leg]))
+if __name__ == "__main__":
+    worst_case = True
+    binary_in = binary_out = streaming = batch = False
+    stats = None
+    validate = True
+    outer = None
+    workers = None
+    parts = ['tripods']
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == '-h':
+            usage()
+            sys.exit(0)
+        elif arg == '-w':
+            worst_case = True
+        elif arg == '-b':
+            worst_case = False
+        elif arg == '-a':
+            worst_case = 'auto'
+        elif arg == '-ib':
+            binary_in = True
+        elif arg == '-ob':
+            binary_out = True
+        elif arg == '-s':
+            streaming = True
+        elif arg == '-m':
+            batch = True
+        elif arg == '--stats':
+            stats = partition_stats()
+        elif arg == '--no-validate':
+            validate = False
+        elif arg == '--outer':
+            outer = next(args, '')
+            if outer not in ('default', 'centre', 'sample'):
+                usage()
+                sys.exit(-1)
+        elif arg == '-j':
+            try:
+                workers = int(next(args, ''))
+            except ValueError:
+                usage()
+                sys.exit(-1)
+        elif arg == '-e':
+            parts = next(args, '').split(',')
+            if not set(parts) <= set(output_parts):
+                usage()
+                sys.exit(-1)
+        else:
+            usage()
+            sys.exit(-1)
+    if streaming and (binary_out or batch or parts != ['tripods']) \
+       or batch and (stats is not None or outer is not None):
+        usage()
+        sys.exit(-1)
+
+    if batch:
+        if binary_in:
+            lists = read_face_lists_binary(sys.stdin.buffer)
+        else:
+            lists = read_face_lists(sys.stdin)
+        lists = [add_missing_face(faces)[0] for faces in lists]
+        partitions, seconds = partition_many(lists, workers=workers,
+                                             worst_case=worst_case,
+                                             validate=validate)
+        for i, tp in enumerate(partitions):
+            sys.stderr.write("{} {} {:.6f}\n".format(i, len(tp.tripod_map),
+                                                     seconds[i]))
+            if binary_out:
+                write_results_binary(tp, parts, sys.stdout.buffer)
+            else:
+                write_results(tp, parts, sys.stdout)
+        sys.exit(0)
+
+    if binary_in:
+        faces = read_faces_binary(sys.stdin.buffer)
+    else:
+        faces = read_faces(sys.stdin)
+    faces, n = add_missing_face(faces)
+    succ = csr_triangulation.from_faces(faces, n)
+
+    if outer is None:
+        outer_face = default_outer_face(succ)
+    else:
+        # with --stats, the leg lengths of each candidate are reported too
+        outer_face, report = choose_outer_face(succ, outer, workers=workers,
+                                               legs=stats is not None)
+        for (face, depth, mean, *legs) in report:
+            sys.stderr.write("outer face {}: depth {}, mean depth {:.2f}"
+                             .format(" ".join(map(str, face)), depth, mean))
+            if legs:
+                sys.stderr.write(", max leg {}, mean leg {:.2f}"
+                                 .format(*legs))
+            sys.stderr.write("\n")
+    if streaming:
+        # there is one tripod for each face, so the count is known upfront
+        sys.stdout.write("{}\n".format(len(faces) // 3))
+        for (_, _, _, legs) in tripod_partition.stream(succ, outer_face,
+                                                       worst_case,
+                                                       stats=stats,
+                                                       validate=validate):
+            sys.stdout.write("".join(" ".join(map(str, leg)) + "\n"
+                                     for leg in legs))
+        if stats is not None:
+            sys.stderr.write(stats.summary() + "\n")
+        sys.exit(0)
+
+    tp = tripod_partition(succ, outer_face, worst_case, workers=workers,
+                          stats=stats, validate=validate)
+    if binary_out:
+        write_results_binary(tp, parts, sys.stdout.buffer)
+    else:
+        write_results(tp, parts, sys.stdout)
+    if stats is not None:
+        sys.stderr.write(stats.summary() + "\n")
@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+"""Benchmarks for lhp.py
+
+Unlike lhp_demo.py, this does not need scipy: the triangulations are generated directly.
+"""
+import sys
+import time
+import random
+import json
+import hashlib
+import platform
+
+import lhp
+
+
+""" Generate a random stacked triangulation with n >= 3 vertices
+
+    Starts with the triangle 0,1,2 and repeatedly inserts a new vertex into
+    a face chosen uniformly at random.  Returns the list of faces (each in
+    counterclockwise order) and the outer face.
+"""
+def stacked_triangulation(n, seed=None):
+    rand = random.Random(seed)
+    faces = [(0, 1, 2)]
+    for v in range(3, n):
+        i = rand.randrange(len(faces))
+        a, b, c = faces[i]
+        faces[i] = (a, b, v)
+        faces.append((b, c, v))
+        faces.append((c, a, v))
+    outer_face = [0, 2, 1]
+    faces.append(tuple(outer_face))
+    return faces, outer_face
+
+""" Generate nested triangles with 3*ceil(n/3) vertices
+
+    Triangle i has vertices 3i, 3i+1 and 3i+2 and lies inside triangle i-1,
+    and the annulus between them is triangulated with 6 faces.  The outer
+    face is triangle 0, so the BFS has depth about n/3.
+"""
+def nested_triangles(n):
+    levels = max(1, (n+2) // 3)
+    faces = list()
+    for i in range(levels-1):
+        for k in range(3):
+            a, b = 3*i + k, 3*i + (k+1) % 3
+            c, d = 3*(i+1) + k, 3*(i+1) + (k+1) % 3
+            faces.append((a, b, d))
+            faces.append((a, d, c))
+    i = 3*(levels-1)
+    faces.append((i, i+1, i+2))
+    outer_face = [0, 2, 1]
+    faces.append(tuple(outer_face))
+    return faces, outer_face
+
+""" Generate a triangulated w x h grid plus an apex outside it
+
+    Each square of the grid is split by a diagonal and the apex is joined to
+    every vertex on the boundary of the grid, so the result has w*h+1
+    vertices.  The outer face is one of the faces at the apex.
+"""
+def grid_triangulation(w, h):
+    w, h = max(w, 2), max(h, 2)
+    v = lambda i, j: i*w + j
+    faces = list()
+    for i in range(h-1):
+        for j in range(w-1):
+            faces.append((v(i, j), v(i, j+1), v(i+1, j+1)))
+            faces.append((v(i, j), v(i+1, j+1), v(i+1, j)))
+    # the boundary in counterclockwise order
+    boundary = [v(0, j) for j in range(w-1)] \
+        + [v(i, w-1) for i in range(h-1)] \
+        + [v(h-1, j) for j in range(w-1, 0, -1)] \
+        + [v(i, 0) for i in range(h-1, 0, -1)]
+    apex = w*h
+    for k in range(len(boundary)):
+        faces.append((boundary[(k+1) % len(boundary)], boundary[k], apex))
+    return faces, list(faces[-1])
+
+""" Apply a random walk of edge flips to a triangulation
+
+    Each step flips a random edge that is not on the outer face, if this
+    does not create a multiple edge.  Returns the new list of faces.
+"""
+def flip_walk(faces, outer_face, n, steps, seed=None):
+    rand = random.Random(seed)
+    succ = faces2succ(faces, n)
+    outer = set(zip(outer_face, outer_face[1:] + outer_face[:1]))
+    for _ in range(steps):
+        u = rand.randrange(n)
+        v = rand.choice(list(succ[u]))
+        x, y = succ[u][v], succ[v][u]
+        if (u, v) in outer or (v, u) in outer or x == y or y in succ[x]:
+            continue
+        del succ[u][v]
+        del succ[v][u]
+        succ[x][u], succ[u][y], succ[y][x] = y, x, u
+        succ[y][v], succ[v][x], succ[x][y] = x, y, v
+    return [(u, v, w) for u in range(n) for (v, w) in succ[u].items()
+            if u < v and u < w]
+
+""" The generators used by bench_suite
+
+    Each maps a size n to (faces, outer_face, number of vertices).
+"""
+generators = {
+    'stacked': lambda n, seed: stacked_triangulation(n, seed) + (n,),
+    'nested': lambda n, seed: nested_triangles(n) + (3*max(1, (n+2)//3),),
+    'grid': lambda n, seed: grid_triangulation(int(n**0.5), int(n**0.5))
+        + (max(int(n**0.5), 2)**2 + 1,),
+    'flips': lambda n, seed: (flip_walk(*stacked_triangulation(n, seed), n,
+                                        4*n, seed), [0, 2, 1], n),
+}
+
+""" Convert a list of faces into the succ representation """
+def faces2succ(faces, n):
+    succ = [dict() for _ in range(n)]
+    for t in faces:
+        for i in range(3):
+            succ[t[i]][t[(i+1)%3]] = t[(i+2)%3]
+    return succ
+
+""" Time tripod_partition with each nearest marked ancestor backend """
+def bench_nma(sizes, seed=0):
+    results = list()
+    for n in sizes:
+        faces, outer_face = stacked_triangulation(n, seed)
+        succ = faces2succ(faces, n)
+        times = dict()
+        for name in lhp.integer_sets:
+            start = time.perf_counter()
+            lhp.tripod_partition(succ, outer_face, verify=False, nma=name)
+            times[name] = time.perf_counter() - start
+        best = min(times, key=times.get)
+        print("n = {:>9}  ".format(n)
+              + "  ".join("{}: {:.3f}s".format(k, v) for k, v in times.items())
+              + "  winner: {}".format(best))
+        results.append((n, times))
+    return results
+
+""" Return a batch of random local edits that can be applied in order
+
+    Returns (flips, insertions) as taken by tripod_partition.update, with
+    the flips done before the insertions.  succ is not modified.
+"""
+def random_edits(succ, outer_face, count, rand):
+    succ = [dict(row) for row in succ]
+    outer = set(zip(outer_face, outer_face[1:] + outer_face[:1]))
+    flips = list()
+    insertions = list()
+    while len(flips) < count // 2:
+        u = rand.randrange(len(succ))
+        v = rand.choice(list(succ[u]))
+        x, y = succ[u][v], succ[v][u]
+        if (u, v) in outer or (v, u) in outer or x == y or y in succ[x]:
+            continue
+        del succ[u][v]
+        del succ[v][u]
+        succ[x][u], succ[u][y], succ[y][x] = y, x, u
+        succ[y][v], succ[v][x], succ[x][y] = x, y, v
+        flips.append((u, v))
+    while len(flips) + len(insertions) < count:
+        a = rand.randrange(len(succ))
+        b = rand.choice(list(succ[a]))
+        c = succ[a][b]
+        if (a, b) in outer or (b, c) in outer or (c, a) in outer:
+            continue
+        w = len(succ)
+        succ.append(dict())
+        for (x, y) in ((a, b), (b, c), (c, a)):
+            succ[x][y], succ[y][w], succ[w][x] = w, x, y
+        insertions.append((a, b, c))
+    return flips, insertions
+
+""" Time the phases of tripod_partition on one triangulation
+
+    Returns a dict with the time taken (in seconds) by the BFS, building the
+    nearest marked ancestor structure, _compute and verify_results.
+"""
+def time_phases(succ, outer_face, worst_case):
+    roots = outer_face[::-1]
+    phases = dict()
+    start = time.perf_counter()
+    t = lhp.bfs_arrays(succ, roots)
+    phases['bfs'] = time.perf_counter() - start
+    start = time.perf_counter()
+    lhp.MarkedAncestorStruct(t, roots)
+    phases['nma'] = time.perf_counter() - start
+    # _setup repeats the two steps above, but this is not timed
+    tp = lhp.tripod_partition.__new__(lhp.tripod_partition)
+    paths = tp._setup(succ, outer_face, 'interval')
+    start = time.perf_counter()
+    tp._compute(paths, worst_case)
+    phases['compute'] = time.perf_counter() - start
+    del tp.index_map
+    del tp.nma
+    start = time.perf_counter()
+    tp.verify_results()
+    phases['verify'] = time.perf_counter() - start
+    return phases
+
+""" Run the benchmark suite and return the results as a dict
+
+    For each generator, size and worst_case in (True, False), times the
+    phases of tripod_partition with time_phases.  The result can be
+    written with json.dump and compared with another run with compare.
+"""
+def bench_suite(sizes, names=None, seed=0):
+    source = open(lhp.__file__, 'rb').read()
+    results = list()
+    for name in names or generators:
+        for n in sizes:
+            faces, outer_face, nv = generators[name](n, seed)
+            succ = lhp.csr_triangulation.from_faces(
+                [v for face in faces for v in face], nv)
+            for worst_case in (True, False):
+                phases = time_phases(succ, outer_face, worst_case)
+                results.append({'generator': name, 'n': nv,
+                                'worst_case': worst_case, 'phases': phases})
+                sys.stderr.write("{:>8} n = {:>9} worst_case = {:<5} {}\n"
+                                 .format(name, nv, str(worst_case), "  ".join(
+                                     "{}: {:.3f}s".format(k, v)
+                                     for k, v in phases.items())))
+    return {'lhp': hashlib.sha256(source).hexdigest()[:12],
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'seed': seed,
+            'results': results}
+
+""" Print the phases that are more than threshold times slower in new """
+def compare(old, new, threshold=1.1):
+    key = lambda r: (r['generator'], r['n'], r['worst_case'])
+    before = {key(r): r['phases'] for r in old['results']}
+    slower = 0
+    for r in new['results']:
+        for phase, t in r['phases'].items():
+            t0 = before.get(key(r), dict()).get(phase)
+            if t0 and t > threshold * t0:
+                print("{} n = {} worst_case = {} {}: {:.3f}s -> {:.3f}s ({:.2f}x)"
+                      .format(*key(r), phase, t0, t, t / t0))
+                slower += 1
+    return slower
+
+""" Time tripod_partition.update against a full rebuild
+
+    For each batch size, applies a batch of random flips and insertions to
+    a partition of a random stacked triangulation with n vertices and
+    compares the time taken by update with the time taken to compute the
+    partition of the edited triangulation from scratch.
+"""
+def bench_update(n, batches, seed=0):
+    rand = random.Random(seed)
+    faces, outer_face = stacked_triangulation(n, seed)
+    succ = faces2succ(faces, n)
+    tp = lhp.tripod_partition(succ, outer_face, verify=False,
+                              incremental=True)
+    results = list()
+    for batch in batches:
+        flips, insertions = random_edits(tp.succ, outer_face, batch, rand)
+        k = len(tp.tripods)
+        start = time.perf_counter()
+        _, replaced, _ = tp.update(flips, insertions)
+        update = time.perf_counter() - start
+        size = sum(end - first for (first, end) in replaced)
+        start = time.perf_counter()
+        lhp.tripod_partition([dict(row) for row in tp.succ], outer_face,
+                             verify=False)
+        rebuild = time.perf_counter() - start
+        print("n = {:>9}  batch = {:>6}  update: {:.3f}s  rebuild: {:.3f}s"
+              "  replaced tripods: {}/{}".format(len(tp.succ), batch, update,
+                                                 rebuild, size, k))
+        results.append((batch, update, rebuild))
+    return results
+
+def usage():
+    print("Benchmarks the nearest marked ancestor backends of lhp.py")
+    print("Usage: {} [-h] [-u] [-s] [-g <generators>] [-o <file>] [-c <file>] <n1> <n2> ..."
+          .format(sys.argv[0]))
+    print("  -h show this message")
+    print("  -u benchmark incremental updates against full rebuilds instead,")
+    print("     with edit batches of 1, 10, 100 and 1000 (default n = 20000)")
+    print("  -s run the benchmark suite instead and write the results as JSON")
+    print("  -g <generators> comma-separated generators for -s, from")
+    print("     {} (default = all)".format(",".join(generators)))
+    print("  -o <file> write the JSON results of -s to file instead of stdout")
+    print("  -c <file> compare the results of -s with the JSON results in file")
+    print("  <n1> <n2> ... the triangulation sizes to use (default = 1000 10000 100000)")
+
+if __name__ == "__main__":
+    sizes = list()
+    updates = suite = False
+    names = output = baseline = None
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == '-h':
+            usage()
+            sys.exit(0)
+        elif arg == '-u':
+            updates = True
+        elif arg == '-s':
+            suite = True
+        elif arg == '-g':
+            names = next(args, '').split(',')
+            if not set(names) <= set(generators):
+                usage()
+                sys.exit(-1)
+        elif arg == '-o':
+            output = next(args, None)
+        elif arg == '-c':
+            baseline = next(args, None)
+        else:
+            sizes.append(int(arg))
+    if suite:
+        results = bench_suite(sizes or [1000, 10000, 100000], names)
+        if output:
+            with open(output, 'w') as fp:
+                json.dump(results, fp, indent=1)
+        else:
+            json.dump(results, sys.stdout, indent=1)
+            print()
+        if baseline:
+            with open(baseline) as fp:
+                compare(json.load(fp), results)
+    elif updates:
+        for n in sizes or [20000]:
+            bench_update(n, [1, 10, 100, 1000])
+    else:
+        if not sizes:
+            sizes = [1000, 10000, 100000]
+        bench_nma(sizes)
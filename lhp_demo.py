@@ -82,13 +82,14 @@ def succ2al(succ):
 
 def usage():
     print("Computes a tripod decomposition of a Delaunay triangulation")
-    print("Usage: {} [-h] [-c] [-r] [-y] [-w] [-b] [-nv] <n>".format(sys.argv[0]))
+    print("Usage: {} [-h] [-c] [-r] [-y] [-w] [-b] [-a] [-nv] <n>".format(sys.argv[0]))
     print("  -h show this message")
     print("  -c use collinear points")
     print("  -y use random points in triangle")
     print("  -r use random points in disk (default)")
     print("  -w use O(n log n) time algorithm (default)")
     print("  -b use O(n^2) time algorithm (usually faster)")
+    print("  -a use a single walk with an O(n log n) fallback")
     print("  -nv don't verify correctness of results")
     print("  <n> the number of points to use (default = 10)")
 
@@ -110,6 +111,8 @@ if __name__ == "__main__":
             worst_case = True
         elif arg == '-b':
             worst_case = False
+        elif arg == '-a':
+            worst_case = 'auto'
         elif arg == '-nv':
             verify = False
         else:
@@ -127,7 +130,10 @@ if __name__ == "__main__":
     print("n = ", n, " m = ", m)
     assert(m == 3*n - 6)
 
-    s = ["O(n^2)", "O(n log n)"][worst_case]
+    if worst_case == 'auto':
+        s = "adaptive O(n log n)"
+    else:
+        s = ["O(n^2)", "O(n log n)"][worst_case]
     s2 = ["", " and verifying results"][verify]
     print("Using {} algorithm{}...".format(s, s2), end='')
     sys.stdout.flush()